@@ -2,9 +2,17 @@ from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
+import base64
+import contextlib
+import copy
+import csv
+import hashlib
+import json
 import shutil
 import os
 import tempfile
+import time
+import zlib
 import torch
 import nibabel as nib
 import torch.nn.functional as F
@@ -23,6 +31,12 @@ from torchmetrics.classification import BinarySpecificity, BinaryRecall
 from torchmetrics.classification import MulticlassSpecificity, MulticlassRecall
 
 
+def no_phase(name):
+    # Default for the `phase` hooks below; StepProfilerCallback swaps in a
+    # recording context manager.
+    return contextlib.nullcontext()
+
+
 def rmse_tt(predictions, targets):
     mse = F.mse_loss(predictions, targets)
     return torch.sqrt(mse)
@@ -85,13 +99,15 @@ class CombinedOptimizer:
         initial_lambda=0.5,
         alpha=1.5,
         eta=0.1,
+        beta=0.1,
     ):
-        self.frank_wolfe = FrankWolfeOptimizer(num_tasks)
+        self.frank_wolfe = FrankWolfeOptimizer(num_tasks, beta=beta)
         self.gradnorm = GradNormOptimizer(model, num_tasks, alpha)
         self.lambda_param = initial_lambda  # Initial lambda value
         self.weights = torch.ones(num_tasks) / num_tasks
         self.device = None
         self.eta = eta  # Learning rate for lambda adaptation
+        self.phase = no_phase
 
     def to(self, device):
         self.device = device
@@ -101,8 +117,14 @@ class CombinedOptimizer:
         return self
 
     def update_weights(self, losses, shared_params):
-        gn_weights = self.gradnorm.update_weights(losses, shared_params)
-        fw_weights = self.frank_wolfe.update_weights(losses)
+        with self.phase("gradnorm_update"):
+            gn_weights = self.gradnorm.update_weights(losses, shared_params)
+        with self.phase("frank_wolfe_update"):
+            fw_weights = self.frank_wolfe.update_weights(losses)
+        with self.phase("lambda_update"):
+            return self.update_lambda(losses, shared_params, gn_weights, fw_weights)
+
+    def update_lambda(self, losses, shared_params, gn_weights, fw_weights):
         grad_norms = []
         for i, loss in enumerate(losses):
             grads = torch.autograd.grad(loss, shared_params, retain_graph=True)
@@ -225,9 +247,9 @@ class AttentionGatingModule(nn.Module):
 
     def forward(self, shared_features, task_specific_features):
         if shared_features.size(1) != task_specific_features.size(1):
-            task_specific_features = F.linear(
-                task_specific_features,
-                torch.eye(shared_features.size(1)).to(task_specific_features.device),
+            raise ValueError(
+                f"Gate inputs must have the same width, got "
+                f"{shared_features.size(1)} and {task_specific_features.size(1)}"
             )
 
         attention_weights = self.attention(shared_features)
@@ -240,6 +262,72 @@ class AttentionGatingModule(nn.Module):
         return gated_features + residual
 
 
+def backbone_blocks(backbone):
+    # Residual blocks of layer1..layer4 in the truncated r3d_18 backbone.
+    return [block for layer in list(backbone)[1:5] for block in layer]
+
+
+def prune_block_channels(block, keep):
+    # Keeps only the `keep` inner channels of a BasicBlock (conv1 outputs and
+    # conv2 inputs). The block's input/output width and the residual path are
+    # left untouched, so the backbone still produces 512-d features.
+    conv1, bn1, conv2 = block.conv1[0], block.conv1[1], block.conv2[0]
+
+    new_conv1 = nn.Conv3d(
+        conv1.in_channels,
+        len(keep),
+        kernel_size=conv1.kernel_size,
+        stride=conv1.stride,
+        padding=conv1.padding,
+        bias=False,
+    )
+    new_bn1 = nn.BatchNorm3d(len(keep), eps=bn1.eps, momentum=bn1.momentum)
+    new_conv2 = nn.Conv3d(
+        len(keep),
+        conv2.out_channels,
+        kernel_size=conv2.kernel_size,
+        stride=conv2.stride,
+        padding=conv2.padding,
+        bias=False,
+    )
+
+    with torch.no_grad():
+        new_conv1.weight.copy_(conv1.weight[keep])
+        new_bn1.weight.copy_(bn1.weight[keep])
+        new_bn1.bias.copy_(bn1.bias[keep])
+        new_bn1.running_mean.copy_(bn1.running_mean[keep])
+        new_bn1.running_var.copy_(bn1.running_var[keep])
+        new_conv2.weight.copy_(conv2.weight[:, keep])
+
+    block.conv1[0], block.conv1[1], block.conv2[0] = new_conv1, new_bn1, new_conv2
+
+
+def prune_backbone(backbone, keep_ratio=0.5):
+    # L1-norm structured pruning of the inner channels of every residual block.
+    widths = []
+    for block in backbone_blocks(backbone):
+        importance = block.conv1[0].weight.detach().abs().sum(dim=(1, 2, 3, 4))
+        num_keep = max(1, int(round(keep_ratio * importance.numel())))
+        keep = torch.argsort(importance, descending=True)[:num_keep].sort().values
+        prune_block_channels(block, keep)
+        widths.append(num_keep)
+    return widths
+
+
+def model_config(state_dict):
+    # Architecture arguments of a MultiTaskAlzheimerModel checkpoint, so that
+    # pruned / distilled students load through the same load_model path.
+    backbone_widths = [
+        state_dict[f"backbone.{layer}.{block}.conv1.0.weight"].shape[0]
+        for layer in range(1, 5)
+        for block in range(2)
+    ]
+    return {
+        "hidden_dim": state_dict["shared_representation.0.weight"].shape[0],
+        "backbone_widths": backbone_widths,
+    }
+
+
 class MultiTaskAlzheimerModel(pl.LightningModule):
     def __init__(
         self,
@@ -247,8 +335,13 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         input_shape=(1, 64, 64, 64),
         metadata_dim=2,
         pretrained=True,
+        hidden_dim=1024,
+        backbone_widths=None,
+        learning_rate=1e-3,
+        optimizer_config=None,
     ):
         super(MultiTaskAlzheimerModel, self).__init__()
+        self.learning_rate = learning_rate
 
         if pretrained:
             self.backbone = r3d_18(weights=R3D_18_Weights.DEFAULT)
@@ -265,6 +358,10 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         )
 
         self.backbone = nn.Sequential(*list(self.backbone.children())[:-1])
+        if backbone_widths is not None:
+            for block, width in zip(backbone_blocks(self.backbone), backbone_widths):
+                if width != block.conv1[0].out_channels:
+                    prune_block_channels(block, torch.arange(width))
         self.metadata_embedding = nn.Sequential(
             nn.Linear(metadata_dim, 256),
             nn.LayerNorm(256),
@@ -286,38 +383,38 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
 
         # Enhanced shared representation
         self.shared_representation = nn.Sequential(
-            nn.Linear(512, 1024),
-            nn.LayerNorm(1024),
+            nn.Linear(512, hidden_dim),
+            nn.LayerNorm(hidden_dim),
             nn.GELU(),
             nn.Dropout(0.3),
-            nn.Linear(1024, 1024),
-            nn.LayerNorm(1024),
+            nn.Linear(hidden_dim, hidden_dim),
+            nn.LayerNorm(hidden_dim),
         )
 
-        self.classification_gate = AttentionGatingModule(1024)
+        self.classification_gate = AttentionGatingModule(hidden_dim)
         self.classification_branch = nn.Sequential(
-            nn.Linear(1024, 512),
-            nn.LayerNorm(512),
+            nn.Linear(hidden_dim, hidden_dim // 2),
+            nn.LayerNorm(hidden_dim // 2),
             nn.GELU(),
             nn.Dropout(0.3),
-            nn.Linear(512, 256),
-            nn.LayerNorm(256),
+            nn.Linear(hidden_dim // 2, hidden_dim // 4),
+            nn.LayerNorm(hidden_dim // 4),
             nn.GELU(),
             nn.Dropout(0.2),
-            nn.Linear(256, num_classes),
+            nn.Linear(hidden_dim // 4, num_classes),
         )
 
-        self.regression_gate = AttentionGatingModule(1024)
+        self.regression_gate = AttentionGatingModule(hidden_dim)
         self.regression_branch = nn.Sequential(
-            nn.Linear(1024, 512),
-            nn.LayerNorm(512),
+            nn.Linear(hidden_dim, hidden_dim // 2),
+            nn.LayerNorm(hidden_dim // 2),
             nn.GELU(),
             nn.Dropout(0.3),
-            nn.Linear(512, 256),
-            nn.LayerNorm(256),
+            nn.Linear(hidden_dim // 2, hidden_dim // 4),
+            nn.LayerNorm(hidden_dim // 4),
             nn.GELU(),
             nn.Dropout(0.2),
-            nn.Linear(256, 1),
+            nn.Linear(hidden_dim // 4, 1),
         )
 
         # Metrics
@@ -334,8 +431,11 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
 
         self.classification_loss = nn.CrossEntropyLoss(label_smoothing=0.1)
         self.regression_loss = nn.HuberLoss()
+        # optimizer_config overrides CombinedOptimizer keyword arguments.
         self.multi_task_optimizer = CombinedOptimizer(
-            self, num_tasks=2, frank_wolfe_weight=0.4, alpha=1.5
+            self,
+            num_tasks=2,
+            **{"frank_wolfe_weight": 0.4, "alpha": 1.5, **(optimizer_config or {})},
         )
 
         if num_classes > 2:
@@ -362,6 +462,8 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         }
 
         self._init_weights()
+        self.heads_fused = False
+        self.phase = no_phase
         self.num_AD = 0
         self.num_CN = 0
         self.num_MCI = 0
@@ -380,28 +482,128 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
     def on_fit_start(self):
         self.multi_task_optimizer.to(self.device)
 
-    def forward(self, image, metadata):
-        x = self.backbone(image)
-        image_features = x.squeeze(-1).squeeze(-1).squeeze(-1)
+    def train(self, mode=True):
+        super(MultiTaskAlzheimerModel, self).train(mode)
+        if mode:
+            self.heads_fused = False
+        return self
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # The fused buffers are copies of the gate weights; rebuild them so a
+        # fused model never serves the weights it had before loading.
+        result = super(MultiTaskAlzheimerModel, self).load_state_dict(
+            state_dict, *args, **kwargs
+        )
+        if self.heads_fused:
+            self.fuse_heads()
+        return result
+
+    def fuse_heads(self):
+        # Inference fast path for the two gates. Both gates receive the shared
+        # features twice, so `s * a + s * (1 - a)` is just `s` and the attention
+        # MLPs drop out; what remains is `s + LayerNorm(Linear(s))` per task,
+        # computed here with one stacked Linear and one LayerNorm call. The
+        # fused parameters are non-persistent buffers, so the state_dict is
+        # unchanged, and they are discarded as soon as the model goes back to
+        # training mode.
+        gates = (self.classification_gate, self.regression_gate)
+        with torch.no_grad():
+            linears = [gate.residual[0] for gate in gates]
+            norms = [gate.residual[1] for gate in gates]
+            self.register_buffer(
+                "fused_residual_weight",
+                torch.cat([linear.weight for linear in linears]),
+                persistent=False,
+            )
+            self.register_buffer(
+                "fused_residual_bias",
+                torch.cat([linear.bias for linear in linears]),
+                persistent=False,
+            )
+            self.register_buffer(
+                "fused_norm_weight",
+                torch.stack([norm.weight for norm in norms]),
+                persistent=False,
+            )
+            self.register_buffer(
+                "fused_norm_bias",
+                torch.stack([norm.bias for norm in norms]),
+                persistent=False,
+            )
+        self.fused_norm_eps = norms[0].eps
+        self.eval()
+        self.heads_fused = True
+        return self
 
+    def fused_gates(self, shared_features):
+        hidden_dim = shared_features.size(1)
+        residual = F.linear(
+            shared_features, self.fused_residual_weight, self.fused_residual_bias
+        ).view(-1, 2, hidden_dim)
+        residual = F.layer_norm(residual, (hidden_dim,), eps=self.fused_norm_eps)
+        residual = torch.addcmul(self.fused_norm_bias, residual, self.fused_norm_weight)
+        gated_features = residual.add_(shared_features.unsqueeze(1))
+        return gated_features[:, 0], gated_features[:, 1]
+
+    def forward_heads(self, image_features, metadata):
         metadata_features = self.metadata_embedding(metadata)
         fused_features = self.cross_attention(
             torch.cat([image_features, metadata_features], dim=1)
         )
         shared_features = self.shared_representation(fused_features)
-        classification_features = self.classification_gate(
-            shared_features, shared_features
-        )
-        classification_output = self.classification_branch(classification_features)
 
-        regression_features = self.regression_gate(shared_features, shared_features)
+        if self.heads_fused:
+            classification_features, regression_features = self.fused_gates(
+                shared_features
+            )
+        else:
+            classification_features = self.classification_gate(
+                shared_features, shared_features
+            )
+            regression_features = self.regression_gate(shared_features, shared_features)
+
+        classification_output = self.classification_branch(classification_features)
         regression_output = self.regression_branch(regression_features)
 
         return classification_output, regression_output
 
+    def forward(self, image, metadata):
+        image_features = self.backbone(image).flatten(1)
+        return self.forward_heads(image_features, metadata)
+
+    def batch_forward(self, batch, metadata):
+        # Batches from cached backbone embeddings (see cache_embeddings) carry
+        # "image_features" instead of "image" and only run the heads.
+        if "image_features" in batch:
+            return self.forward_heads(batch["image_features"], metadata)
+        return self(batch["image"], metadata)
+
+    def forward_with_explanation(self, image, metadata, target_class=None):
+        # Grad-CAM on the last residual stage. The backbone ends in a global
+        # average pool, so the gradient of the class score w.r.t. every spatial
+        # position of a channel is that channel's pooled-feature gradient over
+        # the number of positions: one backward through the heads is enough,
+        # and the backbone runs without autograd.
+        with torch.no_grad():
+            activations = self.backbone[:-1](image)
+            image_features = self.backbone[-1](activations).flatten(1)
+
+        image_features.requires_grad_(True)
+        with torch.enable_grad():
+            classification_output, regression_output = self.forward_heads(
+                image_features, metadata
+            )
+            if target_class is None:
+                target_class = classification_output.argmax(dim=1)
+            score = classification_output.gather(1, target_class.view(-1, 1)).sum()
+            (feature_grads,) = torch.autograd.grad(score, image_features)
+
+        cam = F.relu(torch.einsum("bc,bcdhw->bdhw", feature_grads, activations))
+        cam = cam / cam.flatten(1).amax(dim=1).clamp_min(1e-8).view(-1, 1, 1, 1)
+        return classification_output.detach(), regression_output.detach(), cam
+
     def training_step(self, batch, batch_idx):
-        image, label, mmse, age, gender = (
-            batch["image"],
+        label, mmse, age, gender = (
             batch["label"],
             batch["mmse"],
             batch["age"],
@@ -409,26 +611,39 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         )
         metadata = torch.stack([age, gender], dim=1).float()
 
-        classification_output, regression_output = self(image, metadata)
-
-        classification_loss = self.classification_loss(classification_output, label)
-        regression_loss = self.regression_loss(regression_output.squeeze(), mmse)
-
-        classification_loss.backward(retain_graph=True)
-        grad_norm_classification = torch.norm(
-            torch.stack(
-                [torch.norm(p.grad) for p in self.parameters() if p.grad is not None]
+        with self.phase("forward"):
+            classification_output, regression_output = self.batch_forward(
+                batch, metadata
             )
-        )
-        self.zero_grad()
 
-        regression_loss.backward(retain_graph=True)
-        grad_norm_regression = torch.norm(
-            torch.stack(
-                [torch.norm(p.grad) for p in self.parameters() if p.grad is not None]
+            classification_loss = self.classification_loss(classification_output, label)
+            regression_loss = self.regression_loss(regression_output.squeeze(), mmse)
+
+        with self.phase("backward_classification"):
+            classification_loss.backward(retain_graph=True)
+            grad_norm_classification = torch.norm(
+                torch.stack(
+                    [
+                        torch.norm(p.grad)
+                        for p in self.parameters()
+                        if p.grad is not None
+                    ]
+                )
             )
-        )
-        self.zero_grad()
+            self.zero_grad()
+
+        with self.phase("backward_regression"):
+            regression_loss.backward(retain_graph=True)
+            grad_norm_regression = torch.norm(
+                torch.stack(
+                    [
+                        torch.norm(p.grad)
+                        for p in self.parameters()
+                        if p.grad is not None
+                    ]
+                )
+            )
+            self.zero_grad()
 
         shared_params = list(self.shared_representation.parameters())
 
@@ -440,28 +655,39 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         preds = torch.argmax(classification_output, dim=1)
         acc = (preds == label).float().mean()
 
-        self.log("train_loss", total_loss, on_step=True, on_epoch=True, prog_bar=True)
-        self.log(
-            "train_classification_loss",
-            classification_loss,
-            on_step=True,
-            on_epoch=True,
-        )
-        self.log("train_regression_loss", regression_loss, on_step=True, on_epoch=True)
-        self.log(
-            "train_classification_acc", acc, on_step=True, on_epoch=True, prog_bar=True
-        )
-        self.log("train_classification_weight", weights[0], on_step=True, on_epoch=True)
-        self.log("train_regression_weight", weights[1], on_step=True, on_epoch=True)
-        lambda_info = self.multi_task_optimizer.get_lambda_info()
-
-        self.log("train_lambda", lambda_info["lambda"], on_step=True, on_epoch=True)
-        self.log(
-            "train_gradient_difference",
-            lambda_info["gradient_difference"],
-            on_step=True,
-            on_epoch=True,
-        )
+        with self.phase("logging"):
+            self.log(
+                "train_loss", total_loss, on_step=True, on_epoch=True, prog_bar=True
+            )
+            self.log(
+                "train_classification_loss",
+                classification_loss,
+                on_step=True,
+                on_epoch=True,
+            )
+            self.log(
+                "train_regression_loss", regression_loss, on_step=True, on_epoch=True
+            )
+            self.log(
+                "train_classification_acc",
+                acc,
+                on_step=True,
+                on_epoch=True,
+                prog_bar=True,
+            )
+            self.log(
+                "train_classification_weight", weights[0], on_step=True, on_epoch=True
+            )
+            self.log("train_regression_weight", weights[1], on_step=True, on_epoch=True)
+            lambda_info = self.multi_task_optimizer.get_lambda_info()
+
+            self.log("train_lambda", lambda_info["lambda"], on_step=True, on_epoch=True)
+            self.log(
+                "train_gradient_difference",
+                lambda_info["gradient_difference"],
+                on_step=True,
+                on_epoch=True,
+            )
 
         return total_loss
 
@@ -538,8 +764,7 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
     # plt.close(fig)
 
     def validation_step(self, batch, batch_idx):
-        image, label, mmse, age, gender = (
-            batch["image"],
+        label, mmse, age, gender = (
             batch["label"],
             batch["mmse"],
             batch["age"],
@@ -547,7 +772,7 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         )
         metadata = torch.stack([age, gender], dim=1).float()
 
-        classification_output, regression_output = self(image, metadata)
+        classification_output, regression_output = self.batch_forward(batch, metadata)
 
         classification_loss = self.classification_loss(classification_output, label)
         regression_loss = self.regression_loss(regression_output.squeeze(), mmse)
@@ -578,8 +803,7 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         return total_loss
 
     def test_step(self, batch, batch_idx):
-        image, label, mmse, age, gender = (
-            batch["image"],
+        label, mmse, age, gender = (
             batch["label"],
             batch["mmse"],
             batch["age"],
@@ -596,7 +820,7 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         #         self.num_MCI += 1
 
         metadata = torch.stack([age, gender], dim=1).float()
-        classification_output, regression_output = self(image, metadata)
+        classification_output, regression_output = self.batch_forward(batch, metadata)
 
         classification_loss = self.classification_loss(classification_output, label).to(
             self.device
@@ -697,7 +921,7 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         # ax.legend()
 
     def configure_optimizers(self):
-        optimizer = torch.optim.Adam(self.parameters(), lr=1e-3)
+        optimizer = torch.optim.Adam(self.parameters(), lr=self.learning_rate)
         scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
             optimizer, mode="min", factor=0.1, patience=5
         )
@@ -707,6 +931,600 @@ class MultiTaskAlzheimerModel(pl.LightningModule):
         }
 
 
+def teacher_input(image):
+    # A student trained on smaller volumes (a cascade screener) is compared with
+    # a teacher that still sees them at its own 64^3 input size.
+    if image.shape[2:] == TENSOR_SHAPE[1:]:
+        return image
+    return F.interpolate(
+        image, size=TENSOR_SHAPE[1:], mode="trilinear", align_corners=False
+    )
+
+
+class DistilledAlzheimerModel(MultiTaskAlzheimerModel):
+    # Slim student trained against a frozen MultiTaskAlzheimerModel teacher on
+    # both the AD/CN logits and the MMSE regression output. The student may be
+    # trained on a smaller target_shape than the teacher, see teacher_input.
+    def __init__(self, teacher, temperature=2.0, distill_weight=0.7, **kwargs):
+        super(DistilledAlzheimerModel, self).__init__(**kwargs)
+        self.teacher = teacher
+        self.teacher.requires_grad_(False)
+        self.teacher.eval()
+        self.temperature = temperature
+        self.distill_weight = distill_weight
+
+    @classmethod
+    def from_teacher(cls, teacher, keep_ratio=0.5, hidden_dim=256, **kwargs):
+        num_classes = teacher.classification_branch[-1].out_features
+        student = cls(
+            teacher,
+            num_classes=num_classes,
+            pretrained=False,
+            hidden_dim=hidden_dim,
+            **kwargs,
+        )
+        student.backbone = copy.deepcopy(teacher.backbone)
+        prune_backbone(student.backbone, keep_ratio)
+        student.metadata_embedding.load_state_dict(
+            teacher.metadata_embedding.state_dict()
+        )
+        student.cross_attention.load_state_dict(teacher.cross_attention.state_dict())
+        return student
+
+    def train(self, mode=True):
+        super(DistilledAlzheimerModel, self).train(mode)
+        self.teacher.eval()
+        return self
+
+    def student_state_dict(self):
+        # Same keys as a plain MultiTaskAlzheimerModel, loadable by load_model.
+        return {
+            k: v for k, v in self.state_dict().items() if not k.startswith("teacher.")
+        }
+
+    def training_step(self, batch, batch_idx):
+        image, label, mmse, age, gender = (
+            batch["image"],
+            batch["label"],
+            batch["mmse"],
+            batch["age"],
+            batch["gender"],
+        )
+        metadata = torch.stack([age, gender], dim=1).float()
+
+        with self.phase("forward"):
+            classification_output, regression_output = self(image, metadata)
+        with self.phase("teacher_forward"), torch.no_grad():
+            teacher_classification, teacher_regression = self.teacher(
+                teacher_input(image), metadata
+            )
+
+        T = self.temperature
+        w = self.distill_weight
+        soft_classification_loss = F.kl_div(
+            F.log_softmax(classification_output / T, dim=1),
+            F.softmax(teacher_classification / T, dim=1),
+            reduction="batchmean",
+        ) * (T**2)
+        soft_regression_loss = F.mse_loss(regression_output, teacher_regression)
+
+        classification_loss = (1 - w) * self.classification_loss(
+            classification_output, label
+        ) + w * soft_classification_loss
+        regression_loss = (1 - w) * self.regression_loss(
+            regression_output.squeeze(), mmse
+        ) + w * soft_regression_loss
+
+        shared_params = list(self.shared_representation.parameters())
+
+        losses = [classification_loss.to(self.device), regression_loss.to(self.device)]
+        weights = self.multi_task_optimizer.update_weights(losses, shared_params)
+
+        total_loss = torch.sum(torch.stack(losses) * weights)
+
+        preds = torch.argmax(classification_output, dim=1)
+        acc = (preds == label).float().mean()
+        agreement = (
+            (preds == torch.argmax(teacher_classification, dim=1)).float().mean()
+        )
+
+        with self.phase("logging"):
+            self.log(
+                "train_loss", total_loss, on_step=True, on_epoch=True, prog_bar=True
+            )
+            self.log("train_classification_loss", classification_loss, on_epoch=True)
+            self.log("train_regression_loss", regression_loss, on_epoch=True)
+            self.log(
+                "train_soft_classification_loss",
+                soft_classification_loss,
+                on_epoch=True,
+            )
+            self.log("train_soft_regression_loss", soft_regression_loss, on_epoch=True)
+            self.log("train_classification_acc", acc, on_epoch=True, prog_bar=True)
+            self.log("train_teacher_agreement", agreement, on_epoch=True, prog_bar=True)
+            self.log("train_classification_weight", weights[0], on_epoch=True)
+            self.log("train_regression_weight", weights[1], on_epoch=True)
+
+        return total_loss
+
+
+class MriScanDataset(torch.utils.data.Dataset):
+    # Scans listed in a CSV manifest with columns path,label,mmse,age,gender.
+    # Relative paths are resolved against the manifest's directory.
+    def __init__(self, manifest_path, crop_foreground=False, target_shape=(64, 64, 64)):
+        root = os.path.dirname(os.path.abspath(manifest_path))
+        with open(manifest_path, newline="") as f:
+            self.rows = list(csv.DictReader(f))
+        for row in self.rows:
+            row["path"] = os.path.join(root, row["path"])
+        self.crop_foreground = crop_foreground
+        self.target_shape = tuple(target_shape)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        row = self.rows[idx]
+        image = preprocess_mri_image(
+            row["path"], self.target_shape, crop_foreground=self.crop_foreground
+        )
+        return {
+            "image": image[0],
+            "label": torch.tensor(int(row["label"])),
+            "mmse": torch.tensor(float(row["mmse"])),
+            "age": torch.tensor(float(row["age"])),
+            "gender": torch.tensor(float(row["gender"])),
+        }
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def volume_store_identity(manifest_path, crop_foreground=False):
+    # What a volume store was built from; a store is only reused for the same
+    # manifest (path and contents) and preprocessing options.
+    return {
+        "manifest": os.path.abspath(manifest_path),
+        "manifest_sha256": file_digest(manifest_path),
+        "crop_foreground": bool(crop_foreground),
+        "shape": list(TENSOR_SHAPE),
+    }
+
+
+def volume_store_is_current(path, manifest_path, crop_foreground=False):
+    try:
+        with open(os.path.join(path, "store.json")) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return stored == volume_store_identity(manifest_path, crop_foreground)
+
+
+def build_volume_store(manifest_path, path, crop_foreground=False, num_workers=0):
+    # Preprocesses every scan of a manifest once into path/images.npy, an
+    # (N, 1, 64, 64, 64) float32 array, plus the labels and metadata in
+    # path/columns.npz. store.json holds volume_store_identity; it is removed
+    # first and written last, so it also marks a complete store.
+    dataset = MriScanDataset(manifest_path, crop_foreground=crop_foreground)
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, "store.json")):
+        os.remove(os.path.join(path, "store.json"))
+    images = np.lib.format.open_memmap(
+        os.path.join(path, "images.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(dataset), *TENSOR_SHAPE),
+    )
+    columns = {"label": [], "mmse": [], "age": [], "gender": []}
+    loader = torch.utils.data.DataLoader(dataset, batch_size=1, num_workers=num_workers)
+    for idx, sample in enumerate(loader):
+        images[idx] = sample["image"][0].numpy()
+        for key in columns:
+            columns[key].append(sample[key].numpy())
+    images.flush()
+    del images
+    np.savez(
+        os.path.join(path, "columns.npz"),
+        **{key: np.concatenate(values) for key, values in columns.items()},
+    )
+    with open(os.path.join(path, "store.json"), "w") as f:
+        json.dump(volume_store_identity(manifest_path, crop_foreground), f)
+    return path
+
+
+class VolumeStoreDataset(torch.utils.data.Dataset):
+    # Read-only view of a build_volume_store directory. The volumes are
+    # memory-mapped, so processes reading the same store share one copy in the
+    # page cache instead of decoding and resampling every scan again.
+    def __init__(self, path):
+        self.images = np.load(os.path.join(path, "images.npy"), mmap_mode="r")
+        with np.load(os.path.join(path, "columns.npz")) as data:
+            self.label = torch.from_numpy(data["label"])
+            self.mmse = torch.from_numpy(data["mmse"])
+            self.age = torch.from_numpy(data["age"])
+            self.gender = torch.from_numpy(data["gender"])
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return {
+            "image": torch.from_numpy(np.array(self.images[idx])),
+            "label": self.label[idx],
+            "mmse": self.mmse[idx],
+            "age": self.age[idx],
+            "gender": self.gender[idx],
+        }
+
+
+def cache_embeddings(model, dataloader, path):
+    # Runs the frozen backbone once over a dataset and stores the pooled 512-d
+    # features (float16) with the labels and metadata in a single .npz file.
+    model.eval()
+    device = next(model.parameters()).device
+    columns = {"embeddings": [], "label": [], "mmse": [], "age": [], "gender": []}
+    with torch.no_grad():
+        for batch in dataloader:
+            image_features = model.backbone(batch["image"].to(device)).flatten(1)
+            columns["embeddings"].append(image_features.half().cpu().numpy())
+            for key in ("label", "mmse", "age", "gender"):
+                columns[key].append(batch[key].numpy())
+    np.savez(path, **{key: np.concatenate(values) for key, values in columns.items()})
+    return path
+
+
+class EmbeddingDataset(torch.utils.data.Dataset):
+    # Batches of cached backbone embeddings for MultiTaskAlzheimerModel's
+    # training/validation steps, which then only run the head modules.
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.embeddings = torch.from_numpy(data["embeddings"].astype(np.float32))
+            self.label = torch.from_numpy(data["label"])
+            self.mmse = torch.from_numpy(data["mmse"])
+            self.age = torch.from_numpy(data["age"])
+            self.gender = torch.from_numpy(data["gender"])
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def __getitem__(self, idx):
+        return {
+            "image_features": self.embeddings[idx],
+            "label": self.label[idx],
+            "mmse": self.mmse[idx],
+            "age": self.age[idx],
+            "gender": self.gender[idx],
+        }
+
+
+def augment_batch(
+    images,
+    flip_prob=0.5,
+    max_rotation=0.1,
+    max_scale=0.1,
+    max_translation=0.05,
+    max_intensity_scale=0.1,
+    max_intensity_shift=0.05,
+):
+    # Random flip, rotation, scaling and translation for a whole (B, C, D, H, W)
+    # batch, folded into one affine grid and a single grid_sample call, then a
+    # per-sample intensity scale and shift.
+    batch_size = images.size(0)
+    device, dtype = images.device, images.dtype
+
+    def uniform(*shape, bound):
+        return (torch.rand(*shape, device=device, dtype=dtype) * 2 - 1) * bound
+
+    angles = uniform(batch_size, 3, bound=max_rotation)
+    skew = torch.zeros(batch_size, 3, 3, device=device, dtype=dtype)
+    skew[:, 0, 1], skew[:, 0, 2], skew[:, 1, 2] = (
+        -angles[:, 2],
+        angles[:, 1],
+        -angles[:, 0],
+    )
+    rotation = torch.linalg.matrix_exp(skew - skew.transpose(1, 2))
+
+    scale = 1 + uniform(batch_size, 1, 1, bound=max_scale)
+    flip = torch.where(torch.rand(batch_size, device=device) < flip_prob, -1.0, 1.0)
+    linear = rotation * scale
+    # The last grid coordinate indexes D, the first spatial axis of the volume.
+    linear[:, :, 2] *= flip.to(dtype).unsqueeze(1)
+
+    theta = torch.cat([linear, uniform(batch_size, 3, 1, bound=max_translation)], dim=2)
+    grid = F.affine_grid(theta, images.shape, align_corners=False)
+    images = F.grid_sample(images, grid, mode="bilinear", align_corners=False)
+
+    intensity_scale = 1 + uniform(batch_size, 1, 1, 1, 1, bound=max_intensity_scale)
+    intensity_shift = uniform(batch_size, 1, 1, 1, 1, bound=max_intensity_shift)
+    return torch.addcmul(intensity_shift, images, intensity_scale).clamp_(0, 1)
+
+
+class MriDataModule(pl.LightningDataModule):
+    # Loads MriScanDataset manifests (or build_volume_store directories) in
+    # parallel worker processes and applies augment_batch on the device to whole
+    # training batches.
+    def __init__(
+        self,
+        train_manifest=None,
+        val_manifest=None,
+        test_manifest=None,
+        batch_size=4,
+        num_workers=4,
+        prefetch_factor=2,
+        augment=True,
+        crop_foreground=False,
+        target_shape=(64, 64, 64),
+    ):
+        super(MriDataModule, self).__init__()
+        self.manifests = {
+            "train": train_manifest,
+            "val": val_manifest,
+            "test": test_manifest,
+        }
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.augment = augment
+        self.crop_foreground = crop_foreground
+        self.target_shape = tuple(target_shape)
+        self.datasets = {}
+
+    def setup(self, stage=None):
+        for split, manifest in self.manifests.items():
+            if manifest is None or split in self.datasets:
+                continue
+            if os.path.isdir(manifest):
+                self.datasets[split] = VolumeStoreDataset(manifest)
+            else:
+                self.datasets[split] = MriScanDataset(
+                    manifest,
+                    crop_foreground=self.crop_foreground,
+                    target_shape=self.target_shape,
+                )
+
+    def _dataloader(self, split, shuffle=False):
+        # Lightning skips a loop whose dataloader hook returns an empty list.
+        if split not in self.datasets:
+            return []
+        workers = self.num_workers > 0
+        return torch.utils.data.DataLoader(
+            self.datasets[split],
+            batch_size=self.batch_size,
+            shuffle=shuffle,
+            num_workers=self.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=workers,
+            prefetch_factor=self.prefetch_factor if workers else None,
+        )
+
+    def train_dataloader(self):
+        return self._dataloader("train", shuffle=True)
+
+    def val_dataloader(self):
+        return self._dataloader("val")
+
+    def test_dataloader(self):
+        return self._dataloader("test")
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.augment and self.trainer is not None and self.trainer.training:
+            batch["image"] = augment_batch(batch["image"])
+        return batch
+
+
+class StepProfilerCallback(pl.Callback):
+    # Per-phase wall time, allocations and peak memory of training_step. The
+    # phases come from the `phase` hooks of the model and its CombinedOptimizer,
+    # plus Lightning's backward of the returned loss and the optimizer step.
+    # On CUDA memory is read from the caching allocator on every step; on CPU it
+    # comes from the torch.profiler traces sampled on `profile_steps` (batch
+    # indices within each epoch). Every epoch writes a summary table and one
+    # Chrome trace per sampled step to `output_dir`.
+    def __init__(self, output_dir="profiler", profile_steps=(5,)):
+        super(StepProfilerCallback, self).__init__()
+        self.output_dir = output_dir
+        self.profile_steps = set(profile_steps)
+        self.device = None
+        self.stats = {}
+        self.traces = []
+        self.profiler = None
+        self.step_start = None
+        self.open_phase = None
+
+    def on_fit_start(self, trainer, pl_module):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.device = pl_module.device
+        pl_module.phase = self.phase
+        pl_module.multi_task_optimizer.phase = self.phase
+
+    def on_fit_end(self, trainer, pl_module):
+        pl_module.phase = no_phase
+        pl_module.multi_task_optimizer.phase = no_phase
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _record(self, name, elapsed=None, memory=None):
+        stats = self.stats.setdefault(
+            name,
+            {
+                "calls": 0,
+                "time": 0.0,
+                "memory_samples": 0,
+                "alloc_count": 0,
+                "alloc_bytes": 0,
+                "peak_bytes": 0,
+            },
+        )
+        if elapsed is not None:
+            stats["calls"] += 1
+            stats["time"] += elapsed
+        if memory is not None:
+            alloc_count, alloc_bytes, peak_bytes = memory
+            stats["memory_samples"] += 1
+            stats["alloc_count"] += alloc_count
+            stats["alloc_bytes"] += alloc_bytes
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak_bytes)
+
+    def _start_phase(self, name):
+        self._synchronize()
+        state = {"name": name}
+        if self.device.type == "cuda":
+            memory_stats = torch.cuda.memory_stats(self.device)
+            state["allocations"] = memory_stats.get("allocation.all.allocated", 0)
+            state["allocated_bytes"] = memory_stats.get(
+                "allocated_bytes.all.allocated", 0
+            )
+            state["baseline"] = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        state["range"] = torch.profiler.record_function(name)
+        state["range"].__enter__()
+        state["start"] = time.perf_counter()
+        return state
+
+    def _end_phase(self, state):
+        state["range"].__exit__(None, None, None)
+        self._synchronize()
+        elapsed = time.perf_counter() - state["start"]
+        memory = None
+        if self.device.type == "cuda":
+            memory_stats = torch.cuda.memory_stats(self.device)
+            memory = (
+                memory_stats.get("allocation.all.allocated", 0) - state["allocations"],
+                memory_stats.get("allocated_bytes.all.allocated", 0)
+                - state["allocated_bytes"],
+                torch.cuda.max_memory_allocated(self.device) - state["baseline"],
+            )
+        self._record(state["name"], elapsed, memory)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        state = self._start_phase(name)
+        try:
+            yield
+        except BaseException:
+            state["range"].__exit__(None, None, None)
+            raise
+        self._end_phase(state)
+
+    def _switch_phase(self, name=None):
+        # Phases delimited by Lightning hooks rather than a `with` block.
+        if self.open_phase is not None:
+            self._end_phase(self.open_phase)
+        self.open_phase = self._start_phase(name) if name is not None else None
+
+    def _record_profiled_memory(self, profiler):
+        # CPU allocations of each phase from the record_function ranges: count
+        # and total of the allocating ops below it, and the high-water mark of
+        # allocations minus frees in time order.
+        for event in profiler.events():
+            if event.name not in self.stats or event.name == "step_total":
+                continue
+            descendants, stack = [], list(event.cpu_children)
+            while stack:
+                child = stack.pop()
+                descendants.append(child)
+                stack.extend(child.cpu_children)
+            usage = [
+                e.self_cpu_memory_usage
+                for e in sorted(descendants, key=lambda e: e.time_range.start)
+                if e.self_cpu_memory_usage != 0
+            ]
+            allocations = [u for u in usage if u > 0]
+            peak = max(np.cumsum(usage).max(), 0) if usage else 0
+            self._record(
+                event.name, memory=(len(allocations), sum(allocations), int(peak))
+            )
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        if batch_idx in self.profile_steps:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, profile_memory=True
+            )
+            self.profiler.__enter__()
+        self._synchronize()
+        self.step_start = time.perf_counter()
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        self._switch_phase("backward_total_loss")
+
+    def on_after_backward(self, trainer, pl_module):
+        self._switch_phase()
+
+    def on_before_optimizer_step(self, trainer, pl_module, optimizer):
+        # Runs until on_train_batch_end, so it covers the step itself.
+        self._switch_phase("optimizer_step")
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self._switch_phase()
+        self._synchronize()
+        self._record("step_total", time.perf_counter() - self.step_start)
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            if self.device.type != "cuda":
+                self._record_profiled_memory(self.profiler)
+            self.traces.append((batch_idx, self.profiler))
+            self.profiler = None
+
+    def on_exception(self, trainer, pl_module, exception):
+        if self.open_phase is not None:
+            self.open_phase["range"].__exit__(None, None, None)
+            self.open_phase = None
+        if self.profiler is not None:
+            self.profiler.__exit__(type(exception), exception, exception.__traceback__)
+            self.profiler = None
+        self.on_fit_end(trainer, pl_module)
+
+    def summary(self):
+        step_time = self.stats.get("step_total", {}).get("time", 0.0)
+        lines = [
+            f"{'phase':26s} {'calls':>6s} {'total ms':>10s} {'mean ms':>9s} "
+            f"{'% step':>7s} {'allocs':>8s} {'alloc MB':>9s} {'peak MB':>8s}"
+        ]
+        names = [n for n in self.stats if n != "step_total"] + ["step_total"]
+        for name in names:
+            stats = self.stats.get(name)
+            if stats is None or stats["calls"] == 0:
+                continue
+            samples = max(stats["memory_samples"], 1)
+            memory = (
+                f"{stats['alloc_count'] / samples:8.0f} "
+                f"{stats['alloc_bytes'] / samples / 2**20:9.1f} "
+                f"{stats['peak_bytes'] / 2**20:8.1f}"
+                if stats["memory_samples"]
+                else f"{'-':>8s} {'-':>9s} {'-':>8s}"
+            )
+            lines.append(
+                f"{name:26s} {stats['calls']:6d} {stats['time'] * 1000:10.1f} "
+                f"{stats['time'] / stats['calls'] * 1000:9.2f} "
+                f"{stats['time'] / max(step_time, 1e-9):7.1%} {memory}"
+            )
+        return "\n".join(lines)
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        epoch = trainer.current_epoch
+        summary = self.summary()
+        with open(os.path.join(self.output_dir, f"epoch{epoch}_phases.txt"), "w") as f:
+            f.write(summary + "\n")
+        print(f"Training step profile, epoch {epoch}:\n{summary}")
+
+        for batch_idx, profiler in self.traces:
+            profiler.export_chrome_trace(
+                os.path.join(self.output_dir, f"epoch{epoch}_step{batch_idx}.json")
+            )
+        self.stats = {}
+        self.traces = []
+
+
 # =================================================================================================
 app = FastAPI(title="Alzheimer's Disease Prediction API")
 
@@ -719,12 +1537,22 @@ app.add_middleware(
 )
 
 
+class ExplanationMap(BaseModel):
+    # uint8 Grad-CAM volume (0-255), zlib-compressed and base64-encoded.
+    shape: list[int]
+    dtype: str = "uint8"
+    encoding: str = "zlib+base64"
+    data: str
+
+
 class PredictionResponse(BaseModel):
     predicted_class: int
     class_name: str
     cn_probability: float
     ad_probability: float
     predicted_mmse: float
+    stage: str = "full"
+    explanation: Optional[ExplanationMap] = None
 
 
 def normalize(img):
@@ -748,11 +1576,43 @@ def smoothing(img, sigma=1.0):
         return gaussian_filter(img, sigma=sigma)
 
 
-def preprocess_mri_image(image_path, target_shape=(64, 64, 64)):
+def foreground_bbox(img, threshold=0.1, margin=2, stride=4):
+    # Bounding box of the voxels above `threshold` of the intensity range. The
+    # extents come from axis projections of a foreground mask computed on a
+    # strided view, padded by one stride so the coarse grid never clips tissue.
+    coarse = img[::stride, ::stride, ::stride]
+    min_val = np.min(coarse)
+    max_val = np.max(coarse)
+    mask = coarse > min_val + threshold * (max_val - min_val)
+
+    yz = mask.any(axis=0)
+    profiles = (mask.any(axis=(1, 2)), yz.any(axis=1), yz.any(axis=0))
+
+    bbox = []
+    for profile, size in zip(profiles, img.shape):
+        idx = np.flatnonzero(profile)
+        if idx.size == 0:
+            return tuple(slice(None) for _ in img.shape)
+        start = max((int(idx[0]) - 1) * stride - margin, 0)
+        stop = min((int(idx[-1]) + 2) * stride + margin, size)
+        bbox.append(slice(start, stop))
+    return tuple(bbox)
+
+
+def preprocess_mri_image(image_path, target_shape=(64, 64, 64), crop_foreground=False):
 
     img = nib.load(image_path)
     img_data = img.get_fdata()
 
+    return preprocess_volume(img_data, target_shape, crop_foreground)
+
+
+def preprocess_volume(img_data, target_shape=(64, 64, 64), crop_foreground=False):
+    target_shape = tuple(target_shape)
+
+    if crop_foreground:
+        img_data = img_data[foreground_bbox(img_data)]
+
     img_tensor = torch.tensor(img_data, dtype=torch.float32).unsqueeze(0)
 
     if img_tensor.shape[1:] != target_shape:
@@ -774,21 +1634,154 @@ def preprocess_mri_image(image_path, target_shape=(64, 64, 64)):
     return img_tensor
 
 
+TENSOR_SHAPE = (1, 64, 64, 64)
+TENSOR_DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2")}
+
+
+NPY_HEADER_READERS = {
+    (1, 0): np.lib.format.read_array_header_1_0,
+    (2, 0): np.lib.format.read_array_header_2_0,
+}
+
+
+def read_volume_bytes(file, dtype, fortran_order=False, chunk_size=2**20):
+    # Reads exactly one TENSOR_SHAPE volume straight into a writable buffer that
+    # the returned array wraps, so a float32 volume reaches the model without
+    # another copy. Plain read() in chunks, as SpooledTemporaryFile only has
+    # readinto from Python 3.11; trailing data is rejected by reading one more
+    # byte instead of buffering the rest of the upload.
+    size = int(np.prod(TENSOR_SHAPE)) * dtype.itemsize
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    filled = 0
+    while filled < size:
+        chunk = file.read(min(chunk_size, size - filled))
+        if not chunk:
+            break
+        view[filled : filled + len(chunk)] = chunk
+        filled += len(chunk)
+    if filled != size or file.read(1):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Expected {size} bytes for a {dtype.name} volume "
+            f"of shape {TENSOR_SHAPE}",
+        )
+    order = "F" if fortran_order else "C"
+    return np.frombuffer(buffer, dtype=dtype).reshape(TENSOR_SHAPE, order=order)
+
+
+def read_preprocessed_volume(upload, dtype="float32"):
+    # Reads a (1, 64, 64, 64) volume that was already resampled and normalized by
+    # the client, either as a .npy file or as a raw little-endian buffer. For
+    # .npy files the header is checked before any array data is read.
+    if upload.filename.endswith(".npy"):
+        try:
+            version = np.lib.format.read_magic(upload.file)
+            if version not in NPY_HEADER_READERS:
+                raise ValueError(f"unsupported format version {version}")
+            shape, fortran_order, npy_dtype = NPY_HEADER_READERS[version](upload.file)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid .npy file: {e}")
+        if npy_dtype not in TENSOR_DTYPES.values():
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported dtype {npy_dtype}, expected little-endian "
+                "float32 or float16",
+            )
+        if shape != TENSOR_SHAPE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Expected shape {TENSOR_SHAPE}, got {shape}",
+            )
+        volume = read_volume_bytes(upload.file, npy_dtype, fortran_order)
+    else:
+        if dtype not in TENSOR_DTYPES:
+            raise HTTPException(
+                status_code=400, detail="dtype must be float32 or float16"
+            )
+        volume = read_volume_bytes(upload.file, TENSOR_DTYPES[dtype])
+
+    return torch.from_numpy(volume.astype(np.float32, copy=False)).unsqueeze(0)
+
+
+# run_prediction only sends single scans; batched callers can add buckets with
+# e.g. COMPILE_BATCH_BUCKETS=1,2,4 at the cost of one compile each at startup.
+COMPILE_BATCH_BUCKETS = tuple(
+    int(size) for size in os.environ.get("COMPILE_BATCH_BUCKETS", "1").split(",")
+)
+
+
+def enable_compile_cache(cache_dir):
+    # Inductor keeps its FX graph and autograd caches under this directory; on a
+    # persistent volume, restarted pods reuse the generated kernels instead of
+    # compiling again.
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+
+
+class CompiledInference:
+    # torch.compile'd inference forward. Batches are zero-padded up to a fixed
+    # bucket size so serving compiles once per bucket and never on live traffic;
+    # batches larger than the biggest bucket run eagerly.
+    def __init__(self, model, buckets=COMPILE_BATCH_BUCKETS):
+        self.model = model
+        self.buckets = tuple(sorted(buckets))
+        self.compiled = torch.compile(model, dynamic=False)
+
+    def warmup(self):
+        device = next(self.model.parameters()).device
+        with torch.no_grad():
+            for bucket in self.buckets:
+                self.compiled(
+                    torch.zeros(bucket, *TENSOR_SHAPE, device=device),
+                    torch.zeros(bucket, 2, device=device),
+                )
+
+    def __call__(self, image, metadata):
+        batch_size = image.size(0)
+        bucket = next((b for b in self.buckets if b >= batch_size), None)
+        if bucket is None:
+            return self.model(image, metadata)
+
+        if bucket != batch_size:
+            image = F.pad(image, (0, 0) * (image.dim() - 1) + (0, bucket - batch_size))
+            metadata = F.pad(metadata, (0, 0, 0, bucket - batch_size))
+
+        classification_output, regression_output = self.compiled(image, metadata)
+        return classification_output[:batch_size], regression_output[:batch_size]
+
+
 def load_model(weights_path, device="cuda"):
-    model = MultiTaskAlzheimerModel(num_classes=2)
-    model.load_state_dict(torch.load(weights_path, map_location=device))
+    state_dict = torch.load(weights_path, map_location=device)
+    # Every weight comes from the checkpoint, so skip the Kinetics download.
+    model = MultiTaskAlzheimerModel(
+        num_classes=2, pretrained=False, **model_config(state_dict)
+    )
+    model.load_state_dict(state_dict)
     model.to(device)
-    model.eval()
+    model.fuse_heads()
     return model
 
 
 model = None
 device = None
+crop_foreground = os.environ.get("CROP_FOREGROUND", "0") == "1"
+compiled_model = None
+screener_model = None
+explanation_size = int(os.environ.get("EXPLANATION_SIZE", "32"))
+screener_path = os.environ.get("SCREENER_MODEL_PATH")
+screener_size = int(os.environ.get("SCREENER_INPUT_SIZE", "32"))
+cascade_threshold = float(os.environ.get("CASCADE_THRESHOLD", "0.9"))
+stage_counts = {"screener": 0, "full": 0}
+use_compile = os.environ.get("TORCH_COMPILE", "0") == "1"
+compile_cache_dir = os.environ.get("COMPILE_CACHE_DIR", "compile_cache")
 
 
 @app.on_event("startup")
 async def startup_event():
-    global model, device
+    global model, device, compiled_model, screener_model
     # device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     device = torch.device("cpu")
 
@@ -797,14 +1790,110 @@ async def startup_event():
         model_path = "model_weights.pth"
         model = load_model(model_path, device)
         print("Model loaded successfully!")
+        if use_compile:
+            enable_compile_cache(compile_cache_dir)
+            compiled_model = CompiledInference(model)
+            compiled_model.warmup()
+            print(f"Model compiled for batch sizes {compiled_model.buckets}")
+        if screener_path:
+            screener_model = load_model(screener_path, device)
+            print(
+                f"Cascade enabled: {screener_size}^3 screener, "
+                f"threshold {cascade_threshold}"
+            )
     except Exception as e:
         print(f"Error loading model: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to load model: {str(e)}")
 
 
+def encode_explanation(cam):
+    cam = F.interpolate(
+        cam.unsqueeze(1),
+        size=(explanation_size,) * 3,
+        mode="trilinear",
+        align_corners=False,
+    )[0, 0]
+    quantized = (cam.clamp(0, 1) * 255).round().to(torch.uint8).cpu().numpy()
+    return {
+        "shape": list(quantized.shape),
+        "data": base64.b64encode(zlib.compress(quantized.tobytes())).decode("ascii"),
+    }
+
+
+def run_prediction(image_tensor, age, gender, explain=False):
+    image_tensor = image_tensor.to(device)
+
+    metadata = torch.tensor([[float(age), float(gender)]], dtype=torch.float32).to(
+        device
+    )
+
+    if explain:
+        classification_logits, mmse_pred, cam = model.forward_with_explanation(
+            image_tensor, metadata
+        )
+        response = prediction_response(classification_logits, mmse_pred)
+        response["explanation"] = encode_explanation(cam)
+        return response
+
+    with torch.no_grad():
+        classification_logits, mmse_pred = (compiled_model or model)(
+            image_tensor, metadata
+        )
+
+    return prediction_response(classification_logits, mmse_pred)
+
+
+def prediction_response(classification_logits, mmse_pred, stage="full"):
+    class_probs = torch.softmax(classification_logits, dim=1)
+    predicted_class = torch.argmax(class_probs, dim=1).item()
+
+    class_probabilities = class_probs[0].cpu().numpy()
+    cn_probability = float(class_probabilities[1] * 100)
+    ad_probability = float(class_probabilities[0] * 100)
+
+    mmse_prediction = float(mmse_pred.item())
+
+    class_name = "AD (Alzheimer's Disease)" if predicted_class == 0 else "CN (Normal)"
+    stage_counts[stage] += 1
+    return {
+        "predicted_class": predicted_class,
+        "class_name": class_name,
+        "cn_probability": cn_probability,
+        "ad_probability": ad_probability,
+        "predicted_mmse": mmse_prediction,
+        "stage": stage,
+    }
+
+
+def run_cascade(img_data, age, gender):
+    # The screener answers when its top-class probability reaches the cascade
+    # threshold; other scans are preprocessed at full size for the main model.
+    screener_tensor = preprocess_volume(
+        img_data, (screener_size,) * 3, crop_foreground=crop_foreground
+    )
+    metadata = torch.tensor([[float(age), float(gender)]], dtype=torch.float32).to(
+        device
+    )
+
+    with torch.no_grad():
+        classification_logits, mmse_pred = screener_model(
+            screener_tensor.to(device), metadata
+        )
+
+    confidence = torch.softmax(classification_logits, dim=1).max().item()
+    if confidence >= cascade_threshold:
+        return prediction_response(classification_logits, mmse_pred, stage="screener")
+
+    image_tensor = preprocess_volume(img_data, crop_foreground=crop_foreground)
+    return run_prediction(image_tensor, age, gender)
+
+
 @app.post("/predict/", response_model=PredictionResponse)
 async def predict_alzheimer(
-    mri_file: UploadFile = File(...), age: float = Form(...), gender: float = Form(...)
+    mri_file: UploadFile = File(...),
+    age: float = Form(...),
+    gender: float = Form(...),
+    explain: bool = Form(False),
 ):
     global model, device
 
@@ -816,55 +1905,63 @@ async def predict_alzheimer(
             status_code=400, detail="Only .nii or .nii.gz files are accepted"
         )
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".nii") as temp_file:
-        temp_path = temp_file.name
-        shutil.copyfileobj(mri_file.file, temp_file)
-
+    temp_path = None
     try:
-        image_tensor = preprocess_mri_image(temp_path)
-        image_tensor = image_tensor.to(device)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".nii") as temp_file:
+            temp_path = temp_file.name
+            shutil.copyfileobj(mri_file.file, temp_file)
 
-        metadata = torch.tensor([[float(age), float(gender)]], dtype=torch.float32).to(
-            device
-        )
+        # Explanations always come from the full model.
+        if screener_model is not None and not explain:
+            return run_cascade(nib.load(temp_path).get_fdata(), age, gender)
 
-        with torch.no_grad():
-            classification_logits, mmse_pred = model(image_tensor, metadata)
-            class_probs = torch.softmax(classification_logits, dim=1)
-            predicted_class = torch.argmax(class_probs, dim=1).item()
+        image_tensor = preprocess_mri_image(temp_path, crop_foreground=crop_foreground)
+        return run_prediction(image_tensor, age, gender, explain=explain)
 
-            class_probabilities = class_probs[0].cpu().numpy()
-            cn_probability = float(class_probabilities[1] * 100)
-            ad_probability = float(class_probabilities[0] * 100)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
 
-            mmse_prediction = float(mmse_pred.item())
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.unlink(temp_path)
 
-        class_name = (
-            "AD (Alzheimer's Disease)" if predicted_class == 0 else "CN (Normal)"
-        )
-        response = {
-            "predicted_class": predicted_class,
-            "class_name": class_name,
-            "cn_probability": cn_probability,
-            "ad_probability": ad_probability,
-            "predicted_mmse": mmse_prediction,
-        }
 
-        return response
+@app.post("/predict/tensor/", response_model=PredictionResponse)
+async def predict_alzheimer_tensor(
+    volume_file: UploadFile = File(...),
+    age: float = Form(...),
+    gender: float = Form(...),
+    dtype: str = Form("float32"),
+    explain: bool = Form(False),
+):
+    global model, device
+
+    if not model:
+        raise HTTPException(status_code=500, detail="Model not loaded")
+
+    image_tensor = read_preprocessed_volume(volume_file, dtype)
+
+    try:
+        return run_prediction(image_tensor, age, gender, explain=explain)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
 
-    finally:
-        if os.path.exists(temp_path):
-            os.unlink(temp_path)
-
 
 @app.get("/health")
 async def health_check():
     return {"status": "ok", "model_loaded": model is not None}
 
 
+@app.get("/stats")
+async def stats():
+    return {
+        "cascade_enabled": screener_model is not None,
+        "cascade_threshold": cascade_threshold,
+        "stage_counts": stage_counts,
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,455 @@
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+import pytorch_lightning as pl
+import torch.nn.functional as F
+from fastapi.testclient import TestClient
+
+import backend
+import synthetic
+
+
+def timed(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def serve_random_model():
+    # Untrained weights are enough for latency numbers and avoid needing a
+    # model_weights.pth next to the benchmark.
+    backend.device = torch.device("cpu")
+    backend.model = backend.MultiTaskAlzheimerModel(num_classes=2, pretrained=False)
+    backend.model.fuse_heads()
+    return TestClient(backend.app)
+
+
+def bench_crop(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = synthetic.make_synthetic_nifti(
+            os.path.join(tmp, "scan.nii"), tuple(args.shape)
+        )
+
+        img_data = nib.load(path).get_fdata()
+        bbox = backend.foreground_bbox(img_data)
+        cropped_shape = img_data[bbox].shape
+        print(
+            f"volume {img_data.shape} -> foreground {cropped_shape} "
+            f"({np.prod(cropped_shape) / np.prod(img_data.shape):.1%} of voxels)"
+        )
+
+        for crop in (False, True):
+            ms = timed(
+                lambda: backend.preprocess_mri_image(path, crop_foreground=crop),
+                args.repeats,
+            )
+            print(f"preprocess_mri_image crop_foreground={crop}: {ms:.1f} ms")
+
+
+def bench_tensor_endpoint(args):
+    client = serve_random_model()
+    form = {"age": "70", "gender": "1"}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = synthetic.make_synthetic_nifti(
+            os.path.join(tmp, "scan.nii"), tuple(args.shape)
+        )
+        with open(path, "rb") as f:
+            nifti_bytes = f.read()
+        volume = backend.preprocess_mri_image(path)[0].numpy()
+
+    npy = io.BytesIO()
+    np.save(npy, volume)
+    raw_f32 = volume.astype("<f4").tobytes()
+    raw_f16 = volume.astype("<f2").tobytes()
+    payloads = {
+        "nifti /predict/": ("/predict/", "mri_file", "scan.nii", nifti_bytes, form),
+        "npy /predict/tensor/": (
+            "/predict/tensor/",
+            "volume_file",
+            "v.npy",
+            npy.getvalue(),
+            form,
+        ),
+        "raw f32 /predict/tensor/": (
+            "/predict/tensor/",
+            "volume_file",
+            "v.raw",
+            raw_f32,
+            dict(form, dtype="float32"),
+        ),
+        "raw f16 /predict/tensor/": (
+            "/predict/tensor/",
+            "volume_file",
+            "v.raw",
+            raw_f16,
+            dict(form, dtype="float16"),
+        ),
+    }
+
+    results = {}
+    for name, (url, field, filename, body, data) in payloads.items():
+
+        def post():
+            response = client.post(url, files={field: (filename, body)}, data=data)
+            assert response.status_code == 200, response.text
+            results[name] = response.json()
+
+        ms = timed(post, args.repeats)
+        print(f"{name:26s} {len(body) / 1e6:7.2f} MB {ms:8.1f} ms")
+
+    reference = results["nifti /predict/"]["cn_probability"]
+    for name, result in results.items():
+        diff = result["cn_probability"] - reference
+        print(f"{name:26s} cn_probability diff {diff:+.4f}")
+
+    bad = client.post(
+        "/predict/tensor/",
+        files={"volume_file": ("v.raw", b"\0" * 1024)},
+        data=dict(form, dtype="float32"),
+    )
+    assert bad.status_code == 400, bad.text
+
+
+def count_allocations(fn):
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        fn()
+    # Operators that allocated memory themselves (frees show up as negatives).
+    return sum(1 for e in prof.events() if e.self_cpu_memory_usage > 0)
+
+
+def bench_heads(args):
+    torch.manual_seed(0)
+    model = backend.MultiTaskAlzheimerModel(num_classes=2, pretrained=False).eval()
+    image_features = torch.randn(args.batch_size, 512)
+    metadata = torch.tensor([[70.0, 1.0]]).repeat(args.batch_size, 1)
+    image = torch.rand(args.batch_size, *backend.TENSOR_SHAPE)
+
+    with torch.no_grad():
+        eager = model.forward_heads(image_features, metadata)
+        eager_full = model(image, metadata)
+        model.fuse_heads()
+        fused = model.forward_heads(image_features, metadata)
+        fused_full = model(image, metadata)
+
+    for name, a, b in (
+        ("classification", eager[0], fused[0]),
+        ("regression", eager[1], fused[1]),
+        ("full forward classification", eager_full[0], fused_full[0]),
+        ("full forward regression", eager_full[1], fused_full[1]),
+    ):
+        max_diff = (a - b).abs().max().item()
+        print(f"fused vs eager {name}: max abs diff {max_diff:.3e}")
+        if not torch.allclose(a, b, rtol=1e-4, atol=1e-4):
+            raise SystemExit("fused heads no longer match the eager forward")
+
+    with torch.no_grad():
+        for fused_mode in (False, True):
+            model.heads_fused = fused_mode
+            heads = lambda: model.forward_heads(image_features, metadata)
+            ms = timed(heads, args.repeats)
+            allocations = count_allocations(heads)
+            print(
+                f"heads fused={fused_mode}: {ms:.3f} ms, {allocations} allocations "
+                f"per call (batch {args.batch_size})"
+            )
+
+
+def bench_dataloader(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest = synthetic.make_synthetic_manifest(tmp, args.scans, tuple(args.shape))
+
+        for num_workers in args.workers:
+            datamodule = backend.MriDataModule(
+                train_manifest=manifest,
+                batch_size=args.batch_size,
+                num_workers=num_workers,
+            )
+            datamodule.setup("fit")
+            loader = datamodule.train_dataloader()
+            for epoch in range(2):
+                start = time.perf_counter()
+                images = sum(batch["image"].size(0) for batch in loader)
+                elapsed = time.perf_counter() - start
+            # The second epoch reuses the persistent workers.
+            print(f"num_workers={num_workers}: {images / elapsed:.1f} images/s")
+
+    images = torch.rand(args.batch_size, *backend.TENSOR_SHAPE)
+    ms = timed(lambda: backend.augment_batch(images), 10)
+    print(f"augment_batch: {args.batch_size / ms * 1000:.1f} images/s")
+
+    model = backend.MultiTaskAlzheimerModel(num_classes=2, pretrained=False)
+    metadata = torch.rand(args.batch_size, 2)
+
+    def train_step():
+        classification_output, regression_output = model(images, metadata)
+        (classification_output.sum() + regression_output.sum()).backward()
+
+    ms = timed(train_step, 3)
+    print(f"model forward+backward: {args.batch_size / ms * 1000:.1f} images/s")
+
+
+def unique_graphs():
+    from torch._dynamo.utils import counters
+
+    return counters["stats"]["unique_graphs"]
+
+
+def bench_compile(args):
+    torch.manual_seed(0)
+    model = backend.MultiTaskAlzheimerModel(num_classes=2, pretrained=False)
+    model.fuse_heads()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        backend.enable_compile_cache(cache_dir)
+
+        # Second round drops dynamo's in-process state, like a pod restart that
+        # finds the inductor cache on disk.
+        for label in ("cold cache", "warm cache"):
+            torch._dynamo.reset()
+            graphs = unique_graphs()
+            start = time.perf_counter()
+            compiled = backend.CompiledInference(model, buckets=args.buckets)
+            compiled.warmup()
+            print(
+                f"compile ({label}): {time.perf_counter() - start:.1f} s, "
+                f"{unique_graphs() - graphs} graphs for buckets {compiled.buckets}"
+            )
+
+        graphs = unique_graphs()
+        with torch.no_grad():
+            for batch_size in range(1, max(args.buckets) + 1):
+                image = torch.rand(batch_size, *backend.TENSOR_SHAPE)
+                metadata = torch.rand(batch_size, 2)
+                eager_out = model(image, metadata)
+                compiled_out = compiled(image, metadata)
+                for a, b in zip(eager_out, compiled_out):
+                    if not torch.allclose(a, b, rtol=1e-3, atol=1e-3):
+                        raise SystemExit("compiled forward does not match eager")
+                eager_ms = timed(lambda: model(image, metadata), args.repeats)
+                compiled_ms = timed(lambda: compiled(image, metadata), args.repeats)
+                print(
+                    f"batch {batch_size}: eager {eager_ms:.1f} ms, "
+                    f"compiled {compiled_ms:.1f} ms"
+                )
+        print(f"recompiles while serving: {unique_graphs() - graphs}")
+
+        if args.training:
+            model.train()
+            image = torch.rand(max(args.buckets), *backend.TENSOR_SHAPE)
+            metadata = torch.rand(max(args.buckets), 2)
+
+            def train_step(forward):
+                classification_output, regression_output = forward(image, metadata)
+                (classification_output.sum() + regression_output.sum()).backward()
+
+            torch._dynamo.reset()
+            compiled_train = torch.compile(model)
+            start = time.perf_counter()
+            train_step(compiled_train)
+            print(f"training compile: {time.perf_counter() - start:.1f} s")
+            eager_ms = timed(lambda: train_step(model), args.repeats)
+            compiled_ms = timed(lambda: train_step(compiled_train), args.repeats)
+            print(
+                f"training step: eager {eager_ms:.1f} ms, compiled {compiled_ms:.1f} ms"
+            )
+
+
+def bench_cascade(args):
+    client = serve_random_model()
+    backend.screener_model = backend.MultiTaskAlzheimerModel(
+        num_classes=2, pretrained=False, hidden_dim=256
+    )
+    backend.prune_backbone(backend.screener_model.backbone, keep_ratio=0.5)
+    backend.screener_model.fuse_heads()
+    backend.screener_size = args.screener_size
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = synthetic.make_synthetic_nifti(
+            os.path.join(tmp, "scan.nii"), tuple(args.shape)
+        )
+        with open(path, "rb") as f:
+            nifti_bytes = f.read()
+
+    def post():
+        response = client.post(
+            "/predict/",
+            files={"mri_file": ("scan.nii", nifti_bytes)},
+            data={"age": "70", "gender": "1"},
+        )
+        assert response.status_code == 200, response.text
+        return response.json()["stage"]
+
+    screener_model = backend.screener_model
+    for label, screener, threshold in (
+        ("no cascade", None, 0.0),
+        ("answered by screener", screener_model, 0.0),
+        ("escalated to full", screener_model, 1.1),
+    ):
+        backend.screener_model = screener
+        backend.cascade_threshold = threshold
+        ms = timed(post, args.repeats)
+        print(f"{label:22s} stage={post():9s} {ms:8.1f} ms")
+
+    print(f"stage counts: {client.get('/stats').json()['stage_counts']}")
+
+
+def naive_grad_cam(model, image, metadata):
+    # Textbook Grad-CAM with autograd through the whole network, for checking.
+    with torch.enable_grad():
+        activations = model.backbone[:-1](image)
+        activations.retain_grad()
+        image_features = model.backbone[-1](activations).flatten(1)
+        classification_output, _ = model.forward_heads(image_features, metadata)
+        target = classification_output.argmax(dim=1, keepdim=True)
+        classification_output.gather(1, target).sum().backward()
+    weights = activations.grad.mean(dim=(2, 3, 4), keepdim=True)
+    cam = F.relu((weights * activations).sum(dim=1))
+    return cam / cam.flatten(1).amax(dim=1).clamp_min(1e-8).view(-1, 1, 1, 1)
+
+
+def bench_explain(args):
+    client = serve_random_model()
+    model = backend.model
+    image = torch.rand(1, *backend.TENSOR_SHAPE)
+    metadata = torch.tensor([[70.0, 1.0]])
+
+    _, _, cam = model.forward_with_explanation(image, metadata)
+    max_diff = (cam - naive_grad_cam(model, image, metadata).detach()).abs().max()
+    print(f"single-pass vs full-backward Grad-CAM: max abs diff {max_diff:.3e}")
+    if max_diff > 1e-4:
+        raise SystemExit("single-pass Grad-CAM no longer matches the reference")
+
+    with torch.no_grad():
+        plain_ms = timed(lambda: model(image, metadata), args.repeats)
+    explain_ms = timed(
+        lambda: model.forward_with_explanation(image, metadata), args.repeats
+    )
+    print(
+        f"model forward {plain_ms:.1f} ms, with explanation {explain_ms:.1f} ms "
+        f"(+{explain_ms / plain_ms - 1:.1%})"
+    )
+
+    volume = image[0].numpy()
+    form = {"age": "70", "gender": "1"}
+    for explain in ("false", "true"):
+
+        def post():
+            response = client.post(
+                "/predict/tensor/",
+                files={"volume_file": ("v.raw", volume.tobytes())},
+                data=dict(form, explain=explain),
+            )
+            assert response.status_code == 200, response.text
+            return response
+
+        ms = timed(post, args.repeats)
+        print(
+            f"/predict/tensor/ explain={explain}: {ms:.1f} ms, "
+            f"{len(post().content)} byte response"
+        )
+
+
+def bench_training_profile(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest = synthetic.make_synthetic_manifest(tmp, args.scans, tuple(args.shape))
+        # A validation batch is needed for the val_loss the LR scheduler monitors.
+        datamodule = backend.MriDataModule(
+            train_manifest=manifest,
+            val_manifest=manifest,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+        )
+        model = backend.MultiTaskAlzheimerModel(num_classes=2, pretrained=False)
+        trainer = pl.Trainer(
+            max_epochs=1,
+            limit_val_batches=1,
+            num_sanity_val_steps=0,
+            logger=False,
+            enable_checkpointing=False,
+            enable_progress_bar=False,
+            callbacks=[
+                backend.StepProfilerCallback(
+                    args.output_dir, profile_steps=args.profile_steps
+                )
+            ],
+        )
+        trainer.fit(model, datamodule=datamodule)
+    print(f"Chrome traces written to {args.output_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diagnosing server benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    crop = subparsers.add_parser("crop", help="foreground crop before resampling")
+    crop.add_argument("--shape", type=int, nargs=3, default=[192, 224, 192])
+    crop.add_argument("--repeats", type=int, default=10)
+    crop.set_defaults(func=bench_crop)
+
+    tensor = subparsers.add_parser(
+        "tensor-endpoint", help="preprocessed tensor upload vs NIfTI upload"
+    )
+    tensor.add_argument("--shape", type=int, nargs=3, default=[192, 224, 192])
+    tensor.add_argument("--repeats", type=int, default=10)
+    tensor.set_defaults(func=bench_tensor_endpoint)
+
+    heads = subparsers.add_parser("heads", help="fused inference heads vs eager")
+    heads.add_argument("--batch-size", type=int, default=1)
+    heads.add_argument("--repeats", type=int, default=200)
+    heads.set_defaults(func=bench_heads)
+
+    loader = subparsers.add_parser("dataloader", help="training data pipeline")
+    loader.add_argument("--scans", type=int, default=32)
+    loader.add_argument("--shape", type=int, nargs=3, default=[192, 224, 192])
+    loader.add_argument("--batch-size", type=int, default=4)
+    loader.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    loader.set_defaults(func=bench_dataloader)
+
+    compile_ = subparsers.add_parser("compile", help="torch.compile serving path")
+    compile_.add_argument(
+        "--buckets", type=int, nargs="+", default=list(backend.COMPILE_BATCH_BUCKETS)
+    )
+    compile_.add_argument("--repeats", type=int, default=5)
+    compile_.add_argument("--training", action="store_true")
+    compile_.set_defaults(func=bench_compile)
+
+    cascade = subparsers.add_parser("cascade", help="screener / full model cascade")
+    cascade.add_argument("--shape", type=int, nargs=3, default=[192, 224, 192])
+    cascade.add_argument("--screener-size", type=int, default=32)
+    cascade.add_argument("--repeats", type=int, default=5)
+    cascade.set_defaults(func=bench_cascade)
+
+    explain = subparsers.add_parser("explain", help="Grad-CAM explanation overhead")
+    explain.add_argument("--repeats", type=int, default=10)
+    explain.set_defaults(func=bench_explain)
+
+    profile = subparsers.add_parser(
+        "training-profile", help="per-phase training_step breakdown"
+    )
+    profile.add_argument("--scans", type=int, default=8)
+    profile.add_argument("--shape", type=int, nargs=3, default=[96, 112, 96])
+    profile.add_argument("--batch-size", type=int, default=2)
+    profile.add_argument("--num-workers", type=int, default=2)
+    profile.add_argument("--profile-steps", type=int, nargs="+", default=[1])
+    profile.add_argument("--output-dir", default="profiler")
+    profile.set_defaults(func=bench_training_profile)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import argparse
+
+import nibabel as nib
+import numpy as np
+import torch
+
+import backend
+
+
+def collect_predictions(manifest, screener, full, screener_size, crop_foreground):
+    confidence, screener_pred, full_pred, labels = [], [], [], []
+    rows = backend.MriScanDataset(manifest).rows
+    with torch.no_grad():
+        for row in rows:
+            img_data = nib.load(row["path"]).get_fdata()
+            metadata = torch.tensor([[float(row["age"]), float(row["gender"])]])
+
+            screener_logits, _ = screener(
+                backend.preprocess_volume(
+                    img_data, (screener_size,) * 3, crop_foreground=crop_foreground
+                ),
+                metadata,
+            )
+            full_logits, _ = full(
+                backend.preprocess_volume(img_data, crop_foreground=crop_foreground),
+                metadata,
+            )
+
+            probs = torch.softmax(screener_logits, dim=1)[0]
+            confidence.append(probs.max().item())
+            screener_pred.append(probs.argmax().item())
+            full_pred.append(full_logits.argmax(dim=1).item())
+            labels.append(int(row["label"]))
+    return tuple(np.array(a) for a in (confidence, screener_pred, full_pred, labels))
+
+
+def cascade_metrics(threshold, confidence, screener_pred, full_pred, labels):
+    answered = confidence >= threshold
+    final = np.where(answered, screener_pred, full_pred)
+    return {
+        "screened": answered.mean(),
+        "agreement": (final == full_pred).mean(),
+        "accuracy": (final == labels).mean(),
+    }
+
+
+def pick_threshold(confidence, screener_pred, full_pred, target_agreement):
+    # Walk the scans from most to least confident screener answer; the lowest
+    # threshold whose cumulative disagreement keeps the cascade at or above the
+    # target agreement lets the screener answer as many scans as possible.
+    order = np.argsort(-confidence)
+    sorted_confidence = confidence[order]
+    disagreements = np.cumsum(screener_pred[order] != full_pred[order])
+    agreement = 1 - disagreements / len(confidence)
+
+    # Only cut where the confidence changes so tied scans stay together.
+    boundary = np.append(sorted_confidence[1:] < sorted_confidence[:-1], True)
+    ok = np.flatnonzero(boundary & (agreement >= target_agreement))
+    if ok.size == 0:
+        return None
+    return float(sorted_confidence[ok[-1]])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pick CASCADE_THRESHOLD for a target agreement with the full model"
+    )
+    parser.add_argument("--manifest", required=True)
+    parser.add_argument("--screener", required=True)
+    parser.add_argument("--full", default="model_weights.pth")
+    parser.add_argument("--screener-size", type=int, default=32)
+    parser.add_argument("--target-agreement", type=float, default=0.99)
+    parser.add_argument("--crop-foreground", action="store_true")
+    args = parser.parse_args()
+
+    screener = backend.load_model(args.screener, "cpu")
+    full = backend.load_model(args.full, "cpu")
+    predictions = collect_predictions(
+        args.manifest, screener, full, args.screener_size, args.crop_foreground
+    )
+
+    print(f"{'threshold':>10s} {'screened':>9s} {'agreement':>10s} {'accuracy':>9s}")
+    for threshold in (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99):
+        metrics = cascade_metrics(threshold, *predictions)
+        print(
+            f"{threshold:10.2f} {metrics['screened']:9.1%} "
+            f"{metrics['agreement']:10.1%} {metrics['accuracy']:9.1%}"
+        )
+
+    threshold = pick_threshold(*predictions[:3], args.target_agreement)
+    if threshold is None:
+        print(f"No threshold reaches {args.target_agreement:.1%} agreement")
+        return
+    metrics = cascade_metrics(threshold, *predictions)
+    print(
+        f"CASCADE_THRESHOLD={threshold}: screener answers "
+        f"{metrics['screened']:.1%} of scans at {metrics['agreement']:.1%} agreement"
+    )
+
+
+if __name__ == "__main__":
+    main()
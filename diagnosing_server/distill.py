@@ -0,0 +1,176 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+import backend
+
+
+def evaluate(model, loader, prepare=lambda image: image):
+    preds, labels, mmse_pred, mmse_true = [], [], [], []
+    with torch.no_grad():
+        for batch in loader:
+            metadata = torch.stack([batch["age"], batch["gender"]], dim=1).float()
+            classification_output, regression_output = model(
+                prepare(batch["image"]), metadata
+            )
+            preds.append(torch.argmax(classification_output, dim=1))
+            labels.append(batch["label"])
+            mmse_pred.append(regression_output.view(-1))
+            mmse_true.append(batch["mmse"])
+    preds, labels = torch.cat(preds), torch.cat(labels)
+    mmse_pred, mmse_true = torch.cat(mmse_pred), torch.cat(mmse_true)
+    return {
+        "preds": preds,
+        "mmse_pred": mmse_pred,
+        "accuracy": (preds == labels).float().mean().item(),
+        "mmse_mae": (mmse_pred - mmse_true).abs().mean().item(),
+    }
+
+
+def latency_ms(model, input_size, repeats=20):
+    image = torch.rand(1, 1, input_size, input_size, input_size)
+    metadata = torch.tensor([[70.0, 1.0]])
+    times = []
+    with torch.no_grad():
+        model(image, metadata)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(image, metadata)
+            times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def weights_mb(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+
+def peak_forward_mb(model, input_size):
+    # High-water mark of the CPU memory allocated by one forward at the model's
+    # input size: activations and temporaries on top of the weights, which is
+    # what bounds a small edge box. Allocations minus frees in time order.
+    image = torch.rand(1, 1, input_size, input_size, input_size)
+    metadata = torch.tensor([[70.0, 1.0]])
+    with torch.no_grad(), torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        model(image, metadata)
+    usage = [
+        e.self_cpu_memory_usage
+        for e in sorted(prof.events(), key=lambda e: e.time_range.start)
+        if e.self_cpu_memory_usage != 0
+    ]
+    return max(np.cumsum(usage).max(), 0) / 2**20 if usage else 0.0
+
+
+def report(teacher, student, loader, input_size):
+    teacher_eval = evaluate(teacher, loader, backend.teacher_input)
+    student_eval = evaluate(student, loader)
+
+    print(
+        f"{'':10s} {'params':>10s} {'weights':>10s} {'peak fwd':>10s} "
+        f"{'latency':>10s} {'acc':>7s} {'mmse mae':>9s}"
+    )
+    for name, model, result, size in (
+        ("teacher", teacher, teacher_eval, backend.TENSOR_SHAPE[-1]),
+        ("student", student, student_eval, input_size),
+    ):
+        params = sum(p.numel() for p in model.parameters()) / 1e6
+        print(
+            f"{name:10s} {params:9.2f}M {weights_mb(model):8.1f}MB "
+            f"{peak_forward_mb(model, size):8.1f}MB "
+            f"{latency_ms(model, size):8.1f}ms {result['accuracy']:7.3f} "
+            f"{result['mmse_mae']:9.3f}"
+        )
+
+    agreement = (teacher_eval["preds"] == student_eval["preds"]).float().mean()
+    mmse_gap = (teacher_eval["mmse_pred"] - student_eval["mmse_pred"]).abs().mean()
+    print(f"class agreement with teacher: {agreement.item():.3f}")
+    print(f"mean |MMSE student - teacher|: {mmse_gap.item():.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Prune and distill MultiTaskAlzheimerModel into a slim student"
+    )
+    parser.add_argument("--teacher", default="model_weights.pth")
+    parser.add_argument("--train-manifest", required=True)
+    parser.add_argument("--val-manifest", required=True)
+    parser.add_argument("--output", default="student_weights.pth")
+    parser.add_argument("--keep-ratio", type=float, default=0.5)
+    parser.add_argument("--hidden-dim", type=int, default=256)
+    parser.add_argument(
+        "--input-size",
+        type=int,
+        default=64,
+        help="train the student on N^3 volumes, e.g. 32 for a cascade screener",
+    )
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--distill-weight", type=float, default=0.7)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument(
+        "--compile", action="store_true", help="train the student with torch.compile"
+    )
+    parser.add_argument("--compile-cache-dir", default="compile_cache")
+    parser.add_argument(
+        "--profile-dir", help="write per-phase training step profiles here"
+    )
+    parser.add_argument(
+        "--report-only",
+        action="store_true",
+        help="skip training and compare an existing --output checkpoint",
+    )
+    args = parser.parse_args()
+
+    teacher = backend.load_model(args.teacher, "cpu")
+    datamodule = backend.MriDataModule(
+        train_manifest=args.train_manifest,
+        val_manifest=args.val_manifest,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        target_shape=(args.input_size,) * 3,
+    )
+    datamodule.setup()
+
+    if not args.report_only:
+        student = backend.DistilledAlzheimerModel.from_teacher(
+            teacher,
+            keep_ratio=args.keep_ratio,
+            hidden_dim=args.hidden_dim,
+            temperature=args.temperature,
+            distill_weight=args.distill_weight,
+        )
+        callbacks = []
+        if args.profile_dir:
+            callbacks.append(backend.StepProfilerCallback(args.profile_dir))
+        trainer = pl.Trainer(
+            max_epochs=args.epochs,
+            logger=False,
+            enable_checkpointing=False,
+            callbacks=callbacks,
+        )
+        if args.compile:
+            backend.enable_compile_cache(args.compile_cache_dir)
+            trainer.fit(torch.compile(student), datamodule=datamodule)
+        else:
+            trainer.fit(student, datamodule=datamodule)
+        torch.save(student.student_state_dict(), args.output)
+        print(f"Saved student to {args.output}")
+
+    # Reload through the serving path to make sure the checkpoint is servable.
+    student = backend.load_model(args.output, "cpu")
+    print(
+        f"checkpoint size: teacher {os.path.getsize(args.teacher) / 2**20:.1f}MB, "
+        f"student {os.path.getsize(args.output) / 2**20:.1f}MB"
+    )
+    report(teacher, student, datamodule.val_dataloader(), args.input_size)
+
+
+if __name__ == "__main__":
+    main()
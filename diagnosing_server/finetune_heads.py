@@ -0,0 +1,85 @@
+import argparse
+import hashlib
+import os
+import time
+
+import pytorch_lightning as pl
+import torch
+from torch.utils.data import DataLoader
+
+import backend
+
+
+def cache_key(weights, manifest):
+    # Embeddings depend on the backbone weights and on which scans the manifest
+    # lists, so both go into the cache file name; another site's train.csv or a
+    # new checkpoint gets its own cache instead of reusing stale embeddings.
+    identity = "\n".join(
+        [
+            backend.file_digest(weights),
+            os.path.abspath(manifest),
+            backend.file_digest(manifest),
+        ]
+    )
+    return hashlib.sha256(identity.encode()).hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fine-tune the head modules on cached backbone embeddings"
+    )
+    parser.add_argument("--weights", default="model_weights.pth")
+    parser.add_argument("--train-manifest", required=True)
+    parser.add_argument("--val-manifest", required=True)
+    parser.add_argument("--cache-dir", default="embeddings")
+    parser.add_argument("--output", default="finetuned_weights.pth")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    model = backend.load_model(args.weights, "cpu")
+
+    # Embeddings are cached without augmentation: the backbone only runs once.
+    datamodule = backend.MriDataModule(
+        train_manifest=args.train_manifest,
+        val_manifest=args.val_manifest,
+        batch_size=4,
+        num_workers=args.num_workers,
+        augment=False,
+    )
+    datamodule.setup()
+    os.makedirs(args.cache_dir, exist_ok=True)
+    loaders = {}
+    for split, manifest, dataloader in (
+        ("train", args.train_manifest, datamodule.train_dataloader),
+        ("val", args.val_manifest, datamodule.val_dataloader),
+    ):
+        name = os.path.splitext(os.path.basename(manifest))[0]
+        key = cache_key(args.weights, manifest)
+        path = os.path.join(args.cache_dir, f"{split}-{name}-{key}.npz")
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            backend.cache_embeddings(model, dataloader(), path)
+            print(f"Cached {split} embeddings in {time.perf_counter() - start:.1f} s")
+        loaders[split] = DataLoader(
+            backend.EmbeddingDataset(path),
+            batch_size=args.batch_size,
+            shuffle=split == "train",
+        )
+
+    model.backbone.requires_grad_(False)
+    trainer = pl.Trainer(
+        max_epochs=args.epochs, logger=False, enable_checkpointing=False
+    )
+    start = time.perf_counter()
+    trainer.fit(model, loaders["train"], loaders["val"])
+    print(f"Fine-tuned heads in {time.perf_counter() - start:.1f} s")
+
+    torch.save(model.state_dict(), args.output)
+    backend.load_model(args.output, "cpu")
+    print(f"Saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
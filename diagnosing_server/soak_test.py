@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import csv
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import httpx
+import nibabel as nib
+import numpy as np
+import torch
+
+import backend
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def dir_usage(path):
+    files = [os.path.join(path, name) for name in os.listdir(path)]
+    sizes = [os.path.getsize(f) for f in files if os.path.isfile(f)]
+    return len(sizes), sum(sizes) / 2**20
+
+
+def nifti_bytes(shape, rng):
+    data = rng.random(shape, dtype=np.float32)
+    return nib.Nifti1Image(data, np.eye(4)).to_bytes()
+
+
+def make_payloads(rng, count):
+    # Valid scans of varying size (so get_fdata allocations differ), oversized
+    # scans, and corrupt uploads that fail inside predict_alzheimer.
+    payloads = {"valid": [], "oversized": [], "corrupt": []}
+    for _ in range(count):
+        shape = tuple(int(s) for s in rng.integers(96, 224, size=3))
+        payloads["valid"].append(("scan.nii", nifti_bytes(shape, rng), 200))
+    for _ in range(max(count // 4, 1)):
+        shape = tuple(int(s) for s in rng.integers(320, 384, size=3))
+        payloads["oversized"].append(("big.nii", nifti_bytes(shape, rng), 200))
+    valid = payloads["valid"][0][1]
+    payloads["corrupt"] = [
+        ("truncated.nii", valid[: len(valid) // 3], 500),
+        ("garbage.nii", rng.bytes(4096), 500),
+        ("bad.nii.gz", gzip.compress(rng.bytes(4096)), 500),
+        ("scan.txt", valid[:1024], 400),
+    ]
+    return payloads
+
+
+def summarize(samples, baseline, args):
+    last = samples[-1]
+    failures = []
+    rss_growth = last["rss_mb"] - baseline["rss_mb"]
+    fd_growth = last["open_fds"] - baseline["open_fds"]
+    tmp_growth = last["tmp_mb"] - baseline["tmp_mb"]
+    # No drift check unless both ends have a latency from completed scans.
+    drift = None
+    if baseline["latency_p50_ms"] and last["latency_p50_ms"] is not None:
+        drift = last["latency_p50_ms"] / baseline["latency_p50_ms"]
+    if rss_growth > args.max_rss_growth_mb:
+        failures.append(f"RSS grew {rss_growth:.1f} MB")
+    if fd_growth > args.max_fd_growth:
+        failures.append(f"open file descriptors grew by {fd_growth}")
+    if tmp_growth > args.max_tmp_growth_mb or last["tmp_files"] > baseline["tmp_files"]:
+        failures.append(
+            f"temp dir grew {tmp_growth:.1f} MB / "
+            f"{last['tmp_files'] - baseline['tmp_files']} files"
+        )
+    if drift is not None and drift > args.max_latency_drift:
+        failures.append(f"p50 latency drifted x{drift:.2f}")
+    if last["unexpected"]:
+        failures.append(f"{last['unexpected']} responses with unexpected status")
+
+    print(
+        f"RSS {baseline['rss_mb']:.0f} -> {last['rss_mb']:.0f} MB, "
+        f"fds {baseline['open_fds']} -> {last['open_fds']}, "
+        f"temp {baseline['tmp_files']} -> {last['tmp_files']} files, "
+        f"p50 latency {'n/a' if drift is None else f'x{drift:.2f}'}, "
+        f"{last['requests']} requests"
+    )
+    return failures
+
+
+async def soak(args):
+    rng = np.random.default_rng(args.seed)
+    payloads = make_payloads(rng, args.payloads)
+    kinds = list(payloads)
+    weights = [args.valid_weight, args.oversized_weight, args.corrupt_weight]
+
+    transport = httpx.ASGITransport(app=backend.app)
+    latencies, counters = [], {"requests": 0, "unexpected": 0}
+    stop = time.monotonic() + args.duration
+
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://soak", timeout=None
+    ) as client:
+
+        async def worker(worker_rng):
+            while time.monotonic() < stop:
+                kind = worker_rng.choices(kinds, weights)[0]
+                filename, body, expected = worker_rng.choice(payloads[kind])
+                start = time.perf_counter()
+                response = await client.post(
+                    "/predict/",
+                    files={"mri_file": (filename, body)},
+                    data={"age": "70", "gender": "1"},
+                )
+                if kind == "valid":
+                    latencies.append((time.perf_counter() - start) * 1000)
+                counters["requests"] += 1
+                if response.status_code != expected:
+                    counters["unexpected"] += 1
+
+        started = time.monotonic()
+        samples = []
+
+        def take_sample():
+            tmp_files, tmp_mb = dir_usage(tempfile.gettempdir())
+            # None until a valid scan has completed, never a fake 0 ms.
+            recent = latencies[-args.latency_window :]
+            sample = {
+                "elapsed_s": round(time.monotonic() - started, 1),
+                "rss_mb": rss_mb(),
+                "open_fds": open_fds(),
+                "tmp_files": tmp_files,
+                "tmp_mb": tmp_mb,
+                "latency_p50_ms": float(np.median(recent)) if recent else None,
+                "latency_p95_ms": float(np.percentile(recent, 95)) if recent else None,
+                **counters,
+            }
+            samples.append(sample)
+            print(
+                ", ".join(
+                    f"{k}={'-' if v is None else f'{v:.1f}'}" for k, v in sample.items()
+                )
+            )
+
+        async def monitor():
+            while time.monotonic() + args.sample_interval < stop:
+                await asyncio.sleep(args.sample_interval)
+                take_sample()
+
+        workers = [
+            worker(random.Random(args.seed + i)) for i in range(args.concurrency)
+        ]
+        await asyncio.gather(*workers, monitor())
+        # Final sample once every worker has stopped, so even a run shorter
+        # than --sample-interval gets a report.
+        take_sample()
+
+    # First post-warm-up sample with a latency; without one, the first
+    # post-warm-up sample still anchors RSS, fds and temp files.
+    warm = [s for s in samples if s["elapsed_s"] >= args.warmup] or samples
+    baseline = next((s for s in warm if s["latency_p50_ms"] is not None), warm[0])
+
+    if args.report:
+        with open(args.report, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(samples[0]))
+            writer.writeheader()
+            writer.writerows(samples)
+
+    return summarize(samples, baseline, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Soak test /predict/ in-process for memory, fd and temp-file leaks"
+    )
+    parser.add_argument("--weights", help="model weights; random weights if omitted")
+    parser.add_argument("--duration", type=float, default=3600, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--valid-weight", type=float, default=0.8)
+    parser.add_argument("--oversized-weight", type=float, default=0.05)
+    parser.add_argument("--corrupt-weight", type=float, default=0.15)
+    parser.add_argument("--payloads", type=int, default=8)
+    parser.add_argument("--sample-interval", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=300, help="seconds")
+    parser.add_argument("--latency-window", type=int, default=50)
+    parser.add_argument("--max-rss-growth-mb", type=float, default=200)
+    parser.add_argument("--max-fd-growth", type=int, default=5)
+    parser.add_argument("--max-tmp-growth-mb", type=float, default=1)
+    parser.add_argument("--max-latency-drift", type=float, default=1.5)
+    parser.add_argument("--report", help="write the samples to this CSV file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # A private temp dir so leaked upload files are counted exactly.
+    tempfile.tempdir = tempfile.mkdtemp(prefix="soak-")
+
+    backend.device = torch.device("cpu")
+    if args.weights:
+        backend.model = backend.load_model(args.weights, backend.device)
+    else:
+        backend.model = backend.MultiTaskAlzheimerModel(pretrained=False).fuse_heads()
+
+    failures = asyncio.run(soak(args))
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        print(f"Temp dir kept for inspection: {tempfile.tempdir}")
+        raise SystemExit(1)
+    shutil.rmtree(tempfile.tempdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
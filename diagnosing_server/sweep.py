@@ -0,0 +1,249 @@
+import argparse
+import csv
+import functools
+import logging
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+import backend
+
+# Log-uniform ranges for learning_rate, eta and beta, uniform for the others.
+# CombinedOptimizer's frank_wolfe_weight is not swept: it is accepted but never
+# used. The Frank-Wolfe / GradNorm mix is lambda, which starts at initial_lambda
+# and adapts with step size eta, and both of those are swept.
+SEARCH_SPACE = {
+    "learning_rate": (1e-4, 3e-3, "log"),
+    "alpha": (0.5, 2.5, "linear"),
+    "eta": (0.01, 0.5, "log"),
+    "initial_lambda": (0.1, 0.9, "linear"),
+    "beta": (0.01, 1.0, "log"),
+}
+
+RESULT_FIELDS = (
+    ["trial", "status", "epochs"]
+    + list(SEARCH_SPACE)
+    + ["val_loss", "best_val_loss", "val_classification_acc", "seconds"]
+)
+
+
+def sample_trials(count, seed):
+    rng = np.random.default_rng(seed)
+    trials = []
+    for trial in range(count):
+        params = {"trial": trial}
+        for name, (low, high, scale) in SEARCH_SPACE.items():
+            if scale == "log":
+                params[name] = float(
+                    math.exp(rng.uniform(math.log(low), math.log(high)))
+                )
+            else:
+                params[name] = float(rng.uniform(low, high))
+        trials.append(params)
+    return trials
+
+
+def pin_worker(counter, parallel, threads):
+    # Each pool process keeps to its own block of CPUs, so concurrent trials do
+    # not fight over cores. Slots are handed out from a shared counter; a worker
+    # that replaces a dead one takes the next slot and may share a block, but
+    # never waits for one.
+    with counter.get_lock():
+        slot = counter.value % parallel
+        counter.value += 1
+    cpus = sorted(os.sched_getaffinity(0))
+    start = slot * threads
+    os.sched_setaffinity(0, {cpus[(start + i) % len(cpus)] for i in range(threads)})
+    torch.set_num_threads(threads)
+    # Keep Lightning's per-trial banners out of the streamed results table.
+    logging.getLogger("pytorch_lightning").setLevel(logging.WARNING)
+
+
+class MedianPruningCallback(pl.Callback):
+    # Stops a trial whose val_loss is worse than the given quantile of the other
+    # trials' val_loss at the same epoch. scores is a Manager dict shared by all
+    # trials, keyed by (trial, epoch).
+    def __init__(self, trial, scores, grace_epochs=2, min_trials=4, quantile=0.5):
+        self.trial = trial
+        self.scores = scores
+        self.grace_epochs = grace_epochs
+        self.min_trials = min_trials
+        self.quantile = quantile
+        self.pruned = False
+        self.history = []
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if trainer.sanity_checking or "val_loss" not in trainer.callback_metrics:
+            return
+        epoch = trainer.current_epoch
+        val_loss = trainer.callback_metrics["val_loss"].item()
+        self.history.append(val_loss)
+        self.scores[(self.trial, epoch)] = val_loss
+
+        if epoch + 1 < self.grace_epochs:
+            return
+        others = [
+            loss
+            for (trial, other_epoch), loss in self.scores.items()
+            if other_epoch == epoch and trial != self.trial
+        ]
+        if len(others) < self.min_trials:
+            return
+        if val_loss > np.quantile(others, self.quantile):
+            self.pruned = True
+            trainer.should_stop = True
+
+
+def run_trial(params, args, scores):
+    start = time.perf_counter()
+    row = {**params, "status": "failed", "epochs": 0}
+    try:
+        pl.seed_everything(args.seed + params["trial"], workers=True, verbose=False)
+        model = backend.MultiTaskAlzheimerModel(
+            pretrained=args.pretrained,
+            learning_rate=params["learning_rate"],
+            optimizer_config={
+                key: params[key] for key in ("alpha", "eta", "initial_lambda", "beta")
+            },
+        )
+        datamodule = backend.MriDataModule(
+            train_manifest=os.path.join(args.store_dir, "train"),
+            val_manifest=os.path.join(args.store_dir, "val"),
+            batch_size=args.batch_size,
+            num_workers=0,
+            augment=not args.no_augment,
+        )
+        pruner = MedianPruningCallback(
+            params["trial"],
+            scores,
+            grace_epochs=args.grace_epochs,
+            min_trials=args.min_trials,
+            quantile=args.prune_quantile,
+        )
+        trainer = pl.Trainer(
+            max_epochs=args.epochs,
+            accelerator="cpu",
+            devices=1,
+            logger=False,
+            enable_checkpointing=False,
+            enable_progress_bar=False,
+            enable_model_summary=False,
+            num_sanity_val_steps=0,
+            callbacks=[pruner],
+        )
+        trainer.fit(model, datamodule=datamodule)
+
+        metrics = trainer.callback_metrics
+        row.update(
+            status="pruned" if pruner.pruned else "completed",
+            epochs=len(pruner.history),
+            val_loss=pruner.history[-1] if pruner.history else None,
+            best_val_loss=min(pruner.history, default=None),
+            val_classification_acc=(
+                metrics["val_classification_acc"].item()
+                if "val_classification_acc" in metrics
+                else None
+            ),
+        )
+    except Exception as e:
+        row["status"] = f"failed: {e}"
+    row["seconds"] = round(time.perf_counter() - start, 1)
+    return row
+
+
+def format_row(row):
+    cells = []
+    for field in RESULT_FIELDS:
+        value = row.get(field)
+        if isinstance(value, float):
+            value = f"{value:.4g}"
+        cells.append(f"{'' if value is None else value:>12}")
+    return " ".join(cells)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a parallel hyperparameter sweep of MultiTaskAlzheimerModel"
+    )
+    parser.add_argument("--train-manifest", required=True)
+    parser.add_argument("--val-manifest", required=True)
+    parser.add_argument("--store-dir", default="sweep_store")
+    parser.add_argument("--crop-foreground", action="store_true")
+    parser.add_argument("--trials", type=int, default=16)
+    parser.add_argument("--parallel", type=int, default=4, help="concurrent trials")
+    parser.add_argument(
+        "--threads-per-trial",
+        type=int,
+        help="CPUs pinned to each trial; defaults to an even split",
+    )
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--no-augment", action="store_true")
+    parser.add_argument(
+        "--pretrained", action="store_true", help="start from Kinetics weights"
+    )
+    parser.add_argument("--grace-epochs", type=int, default=3)
+    parser.add_argument("--min-trials", type=int, default=4)
+    parser.add_argument("--prune-quantile", type=float, default=0.5)
+    parser.add_argument("--results", default="sweep_results.csv")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cpus = len(os.sched_getaffinity(0))
+    threads = args.threads_per_trial or max(1, cpus // args.parallel)
+
+    # Decode and resample every scan once; all trials memory-map the result. A
+    # store built from another manifest or crop setting is rebuilt.
+    for split, manifest in (("train", args.train_manifest), ("val", args.val_manifest)):
+        path = os.path.join(args.store_dir, split)
+        if backend.volume_store_is_current(path, manifest, args.crop_foreground):
+            print(f"Reusing volume store {path}")
+            continue
+        start = time.perf_counter()
+        backend.build_volume_store(
+            manifest, path, crop_foreground=args.crop_foreground, num_workers=cpus
+        )
+        print(f"Built volume store {path} in {time.perf_counter() - start:.1f}s")
+
+    trials = sample_trials(args.trials, args.seed)
+    context = multiprocessing.get_context("spawn")
+
+    start = time.perf_counter()
+    with context.Manager() as manager, open(args.results, "w", newline="") as f:
+        scores = manager.dict()
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        print(" ".join(f"{field[:12]:>12}" for field in RESULT_FIELDS))
+
+        with context.Pool(
+            args.parallel,
+            initializer=pin_worker,
+            initargs=(context.Value("i", 0), args.parallel, threads),
+        ) as pool:
+            # Rows arrive in completion order, so the table streams.
+            run = functools.partial(run_trial, args=args, scores=scores)
+            rows = []
+            for row in pool.imap_unordered(run, trials):
+                writer.writerow(row)
+                f.flush()
+                print(format_row(row), flush=True)
+                rows.append(row)
+
+    finished = [row for row in rows if row.get("best_val_loss") is not None]
+    pruned = sum(row["status"] == "pruned" for row in rows)
+    print(
+        f"{len(rows)} trials ({pruned} pruned) in {time.perf_counter() - start:.0f}s "
+        f"on {args.parallel} x {threads} CPUs; results in {args.results}"
+    )
+    if finished:
+        best = min(finished, key=lambda row: row["best_val_loss"])
+        print("Best trial:", format_row(best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+
+def ellipsoid_volume(shape=(192, 224, 192), brain_fraction=0.6, seed=0):
+    # Noisy ellipsoid "brain" centred in a volume of dark background air, and
+    # the mask of its voxels.
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    dist = sum(
+        ((g - s / 2) / (s * brain_fraction / 2)) ** 2 for g, s in zip(grid, shape)
+    )
+    mask = dist <= 1.0
+    data = np.where(mask, 0.6 + 0.4 * rng.random(shape), 0.02 * rng.random(shape))
+    return data.astype(np.float32), mask
+
+
+def make_synthetic_nifti(path, shape=(192, 224, 192), brain_fraction=0.6, seed=0):
+    data, _ = ellipsoid_volume(shape, brain_fraction, seed)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path
+
+
+def make_synthetic_manifest(directory, count, shape):
+    rows = ["path,label,mmse,age,gender"]
+    for i in range(count):
+        make_synthetic_nifti(os.path.join(directory, f"scan{i}.nii"), shape, seed=i)
+        rows.append(f"scan{i}.nii,{i % 2},{20 + i % 10},{60 + i % 20},{i % 2}")
+    manifest = os.path.join(directory, "manifest.csv")
+    with open(manifest, "w") as f:
+        f.write("\n".join(rows) + "\n")
+    return manifest
@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+import backend
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return backend.MultiTaskAlzheimerModel(num_classes=2, pretrained=False).eval()
+
+
+@pytest.fixture
+def inputs():
+    torch.manual_seed(1)
+    return (
+        torch.randn(3, 512),
+        torch.rand(3, *backend.TENSOR_SHAPE),
+        torch.tensor([[70.0, 1.0], [65.0, 0.0], [80.0, 1.0]]),
+    )
+
+
+def assert_outputs_close(expected, actual):
+    for a, b in zip(expected, actual):
+        torch.testing.assert_close(b, a, rtol=1e-4, atol=1e-4)
+
+
+def test_fused_heads_match_eager(model, inputs):
+    image_features, image, metadata = inputs
+    with torch.no_grad():
+        eager_heads = model.forward_heads(image_features, metadata)
+        eager = model(image, metadata)
+        model.fuse_heads()
+        fused_heads = model.forward_heads(image_features, metadata)
+        fused = model(image, metadata)
+
+    assert model.heads_fused
+    assert_outputs_close(eager_heads, fused_heads)
+    assert_outputs_close(eager, fused)
+
+
+def test_fusing_keeps_state_dict_and_training_unfuses(model):
+    keys = set(model.state_dict())
+    model.fuse_heads()
+
+    assert set(model.state_dict()) == keys
+    model.train()
+    assert not model.heads_fused
+
+
+def test_load_state_dict_refreshes_fused_heads(model, inputs):
+    image_features, _, metadata = inputs
+    torch.manual_seed(2)
+    other = backend.MultiTaskAlzheimerModel(num_classes=2, pretrained=False).eval()
+    with torch.no_grad():
+        expected = other.forward_heads(image_features, metadata)
+
+        model.fuse_heads()
+        model.load_state_dict(other.state_dict())
+        actual = model.forward_heads(image_features, metadata)
+
+    assert model.heads_fused
+    assert_outputs_close(expected, actual)
@@ -0,0 +1,55 @@
+import nibabel as nib
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import backend
+import synthetic
+
+
+def reference_preprocess(image_path, target_shape=(64, 64, 64)):
+    # Preprocessing pipeline as it was before the optional stages were added.
+    img_data = nib.load(image_path).get_fdata()
+    img_tensor = torch.tensor(img_data, dtype=torch.float32).unsqueeze(0)
+    if img_tensor.shape[1:] != target_shape:
+        img_tensor = F.interpolate(
+            img_tensor.unsqueeze(0),
+            size=target_shape,
+            mode="trilinear",
+            align_corners=False,
+        ).squeeze(0)
+    img_tensor = backend.smoothing(backend.normalize(img_tensor))
+    return img_tensor.unsqueeze(0)
+
+
+def test_preprocess_without_crop_matches_reference(tmp_path):
+    path = synthetic.make_synthetic_nifti(str(tmp_path / "scan.nii"), (96, 112, 96))
+
+    assert torch.equal(backend.preprocess_mri_image(path), reference_preprocess(path))
+
+
+def test_foreground_bbox_contains_ellipsoid():
+    data, mask = synthetic.ellipsoid_volume((48, 56, 48))
+    bbox = backend.foreground_bbox(data)
+
+    cropped = np.zeros_like(mask)
+    cropped[bbox] = True
+    assert not (mask & ~cropped).any()
+    assert cropped.sum() < mask.size
+
+
+def test_foreground_bbox_of_background_is_full_volume():
+    data = np.zeros((40, 48, 40), dtype=np.float32)
+
+    assert data[backend.foreground_bbox(data)].shape == data.shape
+
+
+def test_dataset_target_shape_and_teacher_input(tmp_path):
+    synthetic.make_synthetic_nifti(str(tmp_path / "scan.nii"), (48, 56, 48))
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("path,label,mmse,age,gender\nscan.nii,1,28,70,0\n")
+
+    image = backend.MriScanDataset(str(manifest), target_shape=(32, 32, 32))[0]["image"]
+
+    assert image.shape == (1, 32, 32, 32)
+    assert backend.teacher_input(image.unsqueeze(0)).shape == (1, *backend.TENSOR_SHAPE)
@@ -0,0 +1,68 @@
+import pytest
+import pytorch_lightning as pl
+import torch
+from torch.utils.data import DataLoader
+
+import backend
+
+
+def embedding_batches(count=4):
+    # Cached-embedding rows, so training only runs the heads.
+    torch.manual_seed(0)
+    return [
+        {
+            "image_features": torch.randn(512),
+            "label": torch.tensor(i % 2),
+            "mmse": torch.tensor(20.0 + i),
+            "age": torch.tensor(70.0),
+            "gender": torch.tensor(float(i % 2)),
+        }
+        for i in range(count)
+    ]
+
+
+def fit(model, callback):
+    trainer = pl.Trainer(
+        max_epochs=1,
+        accelerator="cpu",
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        callbacks=[callback],
+    )
+    trainer.fit(
+        model,
+        DataLoader(embedding_batches(), batch_size=2),
+        DataLoader(embedding_batches(), batch_size=2),
+    )
+
+
+def test_lightning_backward_and_optimizer_step_are_phases(tmp_path):
+    callback = backend.StepProfilerCallback(str(tmp_path), profile_steps=(1,))
+    seen = {}
+    callback.on_train_epoch_end = lambda trainer, pl_module: seen.update(callback.stats)
+    model = backend.MultiTaskAlzheimerModel(num_classes=2, pretrained=False)
+
+    fit(model, callback)
+
+    for phase in ("forward", "backward_total_loss", "optimizer_step", "step_total"):
+        assert seen[phase]["calls"] == 2
+    assert seen["optimizer_step"]["memory_samples"] == 1
+
+
+class FailingModel(backend.MultiTaskAlzheimerModel):
+    def training_step(self, batch, batch_idx):
+        raise RuntimeError("step failed")
+
+
+def test_profiler_is_closed_when_the_step_raises(tmp_path):
+    callback = backend.StepProfilerCallback(str(tmp_path), profile_steps=(0,))
+    model = FailingModel(num_classes=2, pretrained=False)
+
+    with pytest.raises(RuntimeError, match="step failed"):
+        fit(model, callback)
+
+    assert callback.profiler is None
+    assert not torch.autograd.profiler._is_profiler_enabled
+    assert model.phase is backend.no_phase
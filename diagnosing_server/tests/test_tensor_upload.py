@@ -0,0 +1,84 @@
+import io
+import tempfile
+
+import numpy as np
+import pytest
+import torch
+from fastapi import HTTPException, UploadFile
+
+import backend
+
+
+def upload(filename, data):
+    # Same spooled file type FastAPI hands to the endpoint.
+    file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    file.write(data)
+    file.seek(0)
+    return UploadFile(file, filename=filename)
+
+
+def npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def test_npy_and_raw_uploads_match():
+    volume = np.random.default_rng(0).random(backend.TENSOR_SHAPE, dtype=np.float32)
+
+    from_npy = backend.read_preprocessed_volume(upload("v.npy", npy_bytes(volume)))
+    from_raw = backend.read_preprocessed_volume(upload("v.raw", volume.tobytes()))
+    from_f16 = backend.read_preprocessed_volume(
+        upload("v.raw", volume.astype("<f2").tobytes()), "float16"
+    )
+
+    assert torch.equal(from_npy, torch.from_numpy(volume).unsqueeze(0))
+    assert torch.equal(from_raw, from_npy)
+    assert torch.allclose(from_f16, from_npy, atol=1e-3)
+
+
+def test_npy_header_is_checked_before_the_data():
+    # Header of a (4, 64, 64, 64) array with no data behind it: rejected on the
+    # shape alone.
+    header = npy_bytes(np.zeros((4, 64, 64, 64), dtype=np.float32))[:128]
+
+    with pytest.raises(HTTPException) as error:
+        backend.read_preprocessed_volume(upload("v.npy", header))
+    assert error.value.status_code == 400
+    assert "shape" in error.value.detail
+
+
+@pytest.mark.parametrize(
+    "filename, data",
+    [
+        ("v.npy", npy_bytes(np.zeros(backend.TENSOR_SHAPE, dtype=np.float64))),
+        ("v.npy", b"not a numpy file"),
+        ("v.npy", npy_bytes(np.zeros(backend.TENSOR_SHAPE, dtype=np.float32))[:-4]),
+        ("v.raw", b"\0" * 1024),
+        ("v.raw", b"\0" * (4 * 64**3 + 1)),
+    ],
+)
+def test_invalid_uploads_are_rejected(filename, data):
+    with pytest.raises(HTTPException) as error:
+        backend.read_preprocessed_volume(upload(filename, data))
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("filename", ["v.raw", "v.npy", "fortran.npy"])
+def test_float32_uploads_are_not_copied(monkeypatch, filename):
+    volume = np.random.default_rng(0).random(backend.TENSOR_SHAPE, dtype=np.float32)
+    if filename == "fortran.npy":
+        volume = np.asfortranarray(volume)
+    data = npy_bytes(volume) if filename.endswith(".npy") else volume.tobytes()
+    decoded = []
+    read_volume_bytes = backend.read_volume_bytes
+
+    def capture(*args, **kwargs):
+        decoded.append(read_volume_bytes(*args, **kwargs))
+        return decoded[-1]
+
+    monkeypatch.setattr(backend, "read_volume_bytes", capture)
+    tensor = backend.read_preprocessed_volume(upload(filename, data))
+
+    assert np.shares_memory(tensor.numpy(), decoded[0])
+    assert torch.equal(tensor[0], torch.from_numpy(np.ascontiguousarray(volume)))
@@ -0,0 +1,39 @@
+import numpy as np
+import torch
+
+import backend
+import synthetic
+
+
+def test_volume_store_is_reused_only_for_the_same_inputs(tmp_path):
+    manifest = synthetic.make_synthetic_manifest(str(tmp_path), 2, (40, 48, 40))
+    store = str(tmp_path / "store")
+
+    assert not backend.volume_store_is_current(store, manifest)
+    backend.build_volume_store(manifest, store)
+    assert backend.volume_store_is_current(store, manifest)
+    assert not backend.volume_store_is_current(store, manifest, crop_foreground=True)
+
+    sample = backend.VolumeStoreDataset(store)[1]
+    expected = backend.MriScanDataset(manifest)[1]
+    assert torch.equal(sample["image"], expected["image"])
+    assert sample["label"] == expected["label"]
+
+    with open(manifest, "a") as f:
+        f.write("scan0.nii,1,25,70,1\n")
+    assert not backend.volume_store_is_current(store, manifest)
+
+
+def test_rebuilding_replaces_the_store(tmp_path):
+    manifest = synthetic.make_synthetic_manifest(str(tmp_path), 2, (40, 48, 40))
+    store = str(tmp_path / "store")
+    backend.build_volume_store(manifest, store)
+
+    backend.build_volume_store(manifest, store, crop_foreground=True)
+
+    assert backend.volume_store_is_current(store, manifest, crop_foreground=True)
+    assert not backend.volume_store_is_current(store, manifest)
+    assert np.load(tmp_path / "store" / "images.npy").shape == (
+        2,
+        *backend.TENSOR_SHAPE,
+    )